@@ -1,9 +1,16 @@
+import asyncio
+import json
+
 import click
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 
 from .models.models import *
-from .utils import milvus
+from .config import settings
+from .utils import milvus, vector, rocketqa, query_cache, jobs, keyword
+from .utils import background_rocketqa, background_question_set  # noqa 注册任务处理函数
 from .utils.database import engine
+from .utils.logging import setup_logging
 
 
 @click.command()
@@ -11,8 +18,9 @@ def db_init():
     """初始化数据库，建立system用户与公开库"""
     Base.metadata.create_all(engine)
     with Session(engine) as db:
-        qs = db.query(QuestionSet).with_for_update().get(1)
-        if not qs:
+        # 只查 id：已有数据库在 db-upgrade 之前还没有新增的列
+        public_set = db.query(QuestionSet.id).filter(QuestionSet.id == 1).with_for_update().first()
+        if not public_set:
             user = User(name='system', institution='system', role=EnumRole.admin)
             db.add(user)
             db.flush()
@@ -29,6 +37,216 @@ def db_init():
             click.echo('PublicSet Exists.')
 
 
+# 没有用 alembic，已有数据库的新增列在这里补上，语句需可重复执行
+UPGRADE_STATEMENTS = [
+    'ALTER TABLE question_set ADD COLUMN IF NOT EXISTS generation INTEGER NOT NULL DEFAULT 0',
+    'CREATE INDEX IF NOT EXISTS ix_set2user_user_id ON set2user (user_id)',
+    'CREATE INDEX IF NOT EXISTS ix_set2question_question_id ON set2question (question_id)',
+    'CREATE INDEX IF NOT EXISTS ix_question_modified_at_id ON question (modified_at, id)',
+    'CREATE INDEX IF NOT EXISTS ix_question_created_by_modified_at_id ON question (created_by_id, modified_at, id)',
+    "DO $$ BEGIN CREATE TYPE enumsetstatus AS ENUM ('normal', 'publishing', 'unpublishing', 'deleting'); "
+    "EXCEPTION WHEN duplicate_object THEN NULL; END $$",
+    "ALTER TABLE question_set ADD COLUMN IF NOT EXISTS status enumsetstatus NOT NULL DEFAULT 'normal'",
+    'ALTER TABLE job ADD COLUMN IF NOT EXISTS checkpoint JSON',
+]
+
+
+@click.command()
+def db_upgrade():
+    """为已有数据库补充新增的列"""
+    with engine.begin() as conn:
+        for statement in UPGRADE_STATEMENTS:
+            conn.execute(text(statement))
+    click.echo('Database upgraded.')
+
+
+def _column_type(conn, table, column):
+    return conn.execute(text('SELECT data_type FROM information_schema.columns '
+                             'WHERE table_name = :table AND column_name = :column'),
+                        {'table': table, 'column': column}).scalar()
+
+
+def _load_json_embedding(raw):
+    # 旧版本把 json.dumps 的结果存进 JSON 列，实际是套了一层的字符串
+    if raw is None:
+        return None
+    value = json.loads(raw)
+    if isinstance(value, str):
+        value = json.loads(value) if value else None
+    return value
+
+
+@click.command()
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--drop-json/--keep-json', default=True, help='转换完成后是否删除旧的 JSON 列')
+def migrate_embedding(batch_size, drop_json):
+    """把 question.embedding 从 JSON 文本分批转换为 float32 二进制，可重复执行"""
+    with engine.begin() as conn:
+        if _column_type(conn, 'question', 'embedding') != 'bytea':
+            conn.execute(text('ALTER TABLE question RENAME COLUMN embedding TO embedding_json'))
+            conn.execute(text("ALTER TABLE question ADD COLUMN embedding BYTEA NOT NULL DEFAULT ''::bytea"))
+        if _column_type(conn, 'question', 'embedding_json') is None:
+            click.echo('Nothing to migrate.')
+            return
+
+    last_id, converted = 0, 0
+    while True:
+        # 每批一个事务，中断后重跑即可
+        with engine.begin() as conn:
+            rows = conn.execute(text('SELECT id, embedding_json::text AS raw FROM question '
+                                     'WHERE id > :last_id ORDER BY id LIMIT :limit'),
+                                {'last_id': last_id, 'limit': batch_size}).all()
+            if not rows:
+                break
+            params = []
+            for row in rows:
+                value = _load_json_embedding(row.raw)
+                if value:
+                    params.append({'id': row.id, 'embedding': vector.to_bytes(value)})
+            if params:
+                conn.execute(text('UPDATE question SET embedding = :embedding WHERE id = :id'), params)
+            last_id = rows[-1].id
+            converted += len(params)
+        click.echo(f'{converted} embeddings converted (id <= {last_id})')
+
+    if drop_json:
+        with engine.begin() as conn:
+            conn.execute(text('ALTER TABLE question DROP COLUMN embedding_json'))
+    click.echo('Embedding migrated.')
+
+
+@click.command()
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--drop-old/--keep-old', default=False, help='迁移完成后是否删除旧的 _<sid> collection')
+def migrate_layout(batch_size, drop_old):
+    """把每个问题库的 _<sid> collection 迁移为 milvus_collection 下的 partition。
+
+    向量从数据库读取；每个 partition 先删后建，可重复执行。
+    """
+    from .utils.milvus_util import MilvusUtil, MilvusPartitionUtil
+    legacy = MilvusUtil()
+    target = MilvusPartitionUtil(settings.milvus_collection, auto_flush=False)
+    target.create_collection('_1')
+    with Session(engine) as db:
+        sids = [row.id for row in db.query(QuestionSet.id).filter(QuestionSet.id != 1).order_by(QuestionSet.id)]
+
+    for sid in sids:
+        name = '_' + str(sid)
+        if target.has_collection(name):
+            target.drop_collection(name)
+        target.create_collection(name)
+        last_id, moved = 0, 0
+        while True:
+            with Session(engine) as db:
+                rows = db.query(Question.id, Question.embedding) \
+                    .join(set2question, set2question.c.question_id == Question.id) \
+                    .filter(set2question.c.set_id == sid, Question.id > last_id, Question.embedding != b'') \
+                    .order_by(Question.id).limit(batch_size).all()
+            if not rows:
+                break
+            target.insert(name, vector.stack([row.embedding for row in rows]), [row.id for row in rows])
+            last_id = rows[-1].id
+            moved += len(rows)
+        target.flush([name])
+        click.echo(f'{name}: {moved} vectors')
+        if drop_old and legacy.has_collection(name):
+            legacy.drop_collection(name)
+
+    if drop_old and legacy.has_collection('_1'):
+        legacy.drop_collection('_1')
+    click.echo('Layout migrated, set MILVUS_LAYOUT=partition.')
+
+
+@click.command()
+def index_status():
+    """查看各 milvus collection 的数据量、当前索引、期望索引与检索参数"""
+    from .utils.milvus_util import MilvusUtil
+    util = MilvusUtil()
+    for collection in util.list_collections():
+        click.echo(json.dumps(util.indexes.status(collection), ensure_ascii=False, default=str))
+
+
+@click.command()
+@click.argument('collections', nargs=-1)
+@click.option('--force', is_flag=True, help='未达到阈值或索引已是最新也重建')
+def index_build(collections, force):
+    """为需要的 collection 建索引（同步执行），不指定时检查全部"""
+    from .utils.milvus_util import MilvusUtil
+    util = MilvusUtil()
+    for collection in collections or util.list_collections():
+        plan = util.indexes.plan(collection, force)
+        if plan is None:
+            click.echo(f'{collection}: up to date')
+            continue
+        index_type, params, count = plan
+        click.echo(f'{collection}: building {index_type.name} {params} ({count} entities)')
+        util.indexes.build(collection, index_type, params, count)
+
+
+@click.command()
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--if-empty', is_flag=True, help='已有关键词索引时直接返回（prestart.sh 中使用）')
+def keyword_index(batch_size, if_empty):
+    """（重新）建立全部问题的关键词索引，可重复执行"""
+    if if_empty:
+        with Session(engine) as db:
+            if db.query(question_gram.c.question_id).first() is not None:
+                click.echo('Keyword index exists.')
+                return
+    last_id, indexed = 0, 0
+    while True:
+        # 每批一个事务，中断后重跑即可
+        with Session(engine) as db:
+            rows = db.query(Question.id, Question.title, Question.content) \
+                .filter(Question.id > last_id).order_by(Question.id).limit(batch_size).all()
+            if not rows:
+                break
+            keyword.index_questions(db, rows)
+            db.commit()
+            last_id = rows[-1].id
+            indexed += len(rows)
+        click.echo(f'{indexed} questions indexed (id <= {last_id})')
+    click.echo('Keyword index built.')
+
+
+@click.command()
+@click.option('--poll-interval', default=settings.job_poll_interval, show_default=True)
+def worker(poll_interval):
+    """后台任务 worker：认领并执行 job 表中的任务（CSV 编码等），可启动多个"""
+    setup_logging()
+    milvus.add_flush_listener(query_cache.invalidate_collections)
+
+    async def main():
+        try:
+            await jobs.work(poll_interval)
+        finally:
+            await rocketqa.shutdown()
+            milvus.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+@click.command()
+@click.argument('name')
+@click.argument('role', type=click.Choice([role.name for role in EnumRole]))
+def set_role(name, role):
+    """修改用户角色。
+
+    用户信息缓存在各服务进程内，命令行无法使其失效：运行中的进程最多在 user_cache_ttl 秒后看到新角色，
+    撤销 admin 需要立即生效时请重启服务。
+    """
+    with Session(engine) as db:
+        user = db.query(User).filter(User.name == name).first()
+        if user is None:
+            raise click.ClickException(f'User {name} not found')
+        user.role = EnumRole[role]
+        db.commit()
+    click.echo(f'{name} is now {role}, effective within {settings.user_cache_ttl}s.')
+
+
 @click.command()
 def db_drop():
     """清空数据库和milvus"""
@@ -36,9 +254,8 @@ def db_drop():
     Base.metadata.drop_all(engine)
 
     click.echo('清空milvus')
-    status, collections = milvus.client.list_collections()
-    for collection in collections:
-        milvus.client.drop_collection(collection)
+    for collection in milvus.list_collections():
+        milvus.drop_collection(collection)
 
 
 @click.group()
@@ -47,7 +264,15 @@ def group():
 
 
 group.add_command(db_init)
+group.add_command(db_upgrade)
 group.add_command(db_drop)
+group.add_command(migrate_embedding)
+group.add_command(migrate_layout)
+group.add_command(index_status)
+group.add_command(index_build)
+group.add_command(worker)
+group.add_command(set_role)
+group.add_command(keyword_index)
 
 if __name__ == '__main__':
     group()
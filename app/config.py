@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseSettings
 
 
@@ -8,8 +10,77 @@ class Settings(BaseSettings):
     milvus_host: str
     milvus_port: int
     rocketqa_url: str
+    # 编码模型，变化后 embedding_store 中的旧向量不再命中
+    rocketqa_model: str = 'zh_dureader_de_v2'
     database_uri: str
+    # 默认由 database_uri 换成 asyncpg 驱动
+    async_database_uri: Optional[str] = None
+    async_pool_size: int = 20
+    async_max_overflow: int = 10
+    # 同一请求中同一形状的语句超过这个次数时警告（可能是 N+1）
+    sql_repeat_warn_threshold: int = 10
     log_level: str = 'INFO'
+    # 向量检索后端：milvus / numpy（进程内，无需 milvus）/ auto（小问题库在进程内检索）
+    vector_backend: str = 'milvus'
+    local_index_max_size: int = 5000
+    # milvus 存储布局：collection（每个问题库一个 collection，公开问题另存一份到 _1）
+    # 或 partition（共用 milvus_collection，每个问题库一个 partition）
+    milvus_layout: str = 'collection'
+    milvus_collection: str = 'qa'
+    # milvus 索引：数据量达到阈值后自动建索引，阈值为 0 表示不使用该类型
+    index_ivf_threshold: int = 20000
+    index_hnsw_threshold: int = 0
+    index_sq8_threshold: int = 1000000
+    index_rebuild_ratio: float = 2.0
+    index_check_interval: float = 60.0
+    index_nprobe: int = 32
+    index_ef: int = 64
+    index_hnsw_m: int = 16
+    index_hnsw_ef_construction: int = 200
+    # milvus 写入合并：攒够条数或超过时间（秒）后统一写入并 flush
+    milvus_write_behind: bool = True
+    milvus_write_max_pending: int = 2000
+    milvus_write_max_age: float = 1.0
+    # 查询向量缓存，size 为 0 时关闭
+    embedding_cache_size: int = 10000
+    embedding_cache_ttl: int = 3600
+    # 查询结果缓存，按问题库的 generation 失效
+    query_cache_size: int = 10000
+    query_cache_ttl: int = 600
+    # 用户信息与维护的问题库缓存，其他进程中的修改最多延迟 ttl 秒生效
+    user_cache_size: int = 10000
+    user_cache_ttl: int = 60
+    acl_cache_size: int = 10000
+    acl_cache_ttl: int = 30
+    batch_query_max_size: int = 100
+    # 关键词检索至少命中查询词的比例
+    keyword_min_match: float = 0.6
+    # /api/query 默认模式：vector 只用向量检索；hybrid 同时做关键词与向量检索并融合排序，
+    # 向量检索（编码 + milvus）超过 query_latency_budget 秒时只返回关键词结果
+    query_mode: str = 'vector'
+    query_latency_budget: float = 1.0
+    query_rrf_k: int = 60
+    # CSV 导入：每块行数与同时编码的块数
+    import_chunk_size: int = 500
+    import_encode_concurrency: int = 2
+    # 后台任务：job_worker 为 True 时由 python -m app.commands worker 执行，否则每个 web 进程都轮询执行；
+    # 执行中的任务超过 job_lease 秒没有进度即视为中断，由其他进程重新认领
+    job_worker: bool = False
+    job_max_attempts: int = 5
+    job_retry_backoff: float = 10.0
+    job_lease: float = 300.0
+    job_poll_interval: float = 2.0
+    # RocketQA 连接池，bulk 用于批量编码段落
+    rocketqa_timeout: float = 30.0
+    rocketqa_bulk_timeout: Optional[float] = None
+    rocketqa_max_connections: int = 100
+    rocketqa_max_keepalive: int = 20
+    rocketqa_keepalive_expiry: float = 30.0
+    # 向量以 float32 二进制传输，关闭后使用 JSON
+    rocketqa_binary: bool = True
+    # 合并并发的查询编码，窗口单位为秒，为 0 时关闭
+    rocketqa_batch_window: float = 0.005
+    rocketqa_batch_max_size: int = 32
 
     class Config:
         env_file = '.env'
@@ -1,9 +1,12 @@
 from typing import Optional
 
-from fastapi import Request, HTTPException, status
+from fastapi import Request, HTTPException, status, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from .utils.database import SessionLocal
+from .utils import users
+from .utils.database import SessionLocal, AsyncSessionLocal
+from .utils.users import CurrentUser
 
 
 def get_db() -> Session:
@@ -14,6 +17,11 @@ def get_db() -> Session:
         db.close()
 
 
+async def get_async_db() -> AsyncSession:
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 def get_logged_user(request: Request) -> int:
     user_id = request.session.get('user_id')
     if user_id is not None:
@@ -24,3 +32,17 @@ def get_logged_user(request: Request) -> int:
 
 def get_user(request: Request) -> Optional[int]:
     return request.session.get('user_id')
+
+
+async def get_current_user(user_id: int = Depends(get_logged_user)) -> CurrentUser:
+    """已登录用户的只读信息，优先取进程内缓存；同一请求中只解析一次"""
+    user = await users.load_user(user_id)
+    if user is None:  # session 中的用户已被删除
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Please login")
+    return user
+
+
+async def get_optional_user(user_id: Optional[int] = Depends(get_user)) -> Optional[CurrentUser]:
+    if user_id is None:
+        return None
+    return await users.load_user(user_id)
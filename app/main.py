@@ -1,13 +1,13 @@
 import os
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
 from starlette.middleware.sessions import SessionMiddleware
 
 from .config import settings
 from .routes import router
-from .utils import instrumentator
+from .utils import instrumentator, rocketqa, milvus, query_cache, sql_metrics, jobs
 from .utils.logging import setup_logging
 
 app = FastAPI()
@@ -26,12 +26,28 @@ app.add_middleware(
 setup_logging()
 
 
+@app.middleware('http')
+async def sql_metrics_middleware(request: Request, call_next):
+    stats = sql_metrics.start_request(request.url.path)
+    response = await call_next(request)
+    route = request.scope.get('route')
+    sql_metrics.finish_request(stats, route.path if route else 'unmatched')
+    return response
+
+
 @app.on_event("startup")
 async def startup_event():
     logger.info('Server [{}] starting...', os.getpid())
     instrumentator.instrument(app).expose(app, include_in_schema=True)
+    await rocketqa.startup()
+    milvus.add_flush_listener(query_cache.invalidate_collections)
+    if not settings.job_worker:
+        jobs.start_polling(settings.job_poll_interval)
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await jobs.stop_polling()
+    await rocketqa.shutdown()
+    milvus.close()
     logger.info('Server [{}] shutdown.', os.getpid())
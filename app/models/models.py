@@ -1,7 +1,8 @@
 import enum
 from datetime import datetime
 
-from sqlalchemy import Column, Enum, ForeignKey, Integer, Table, String, PrimaryKeyConstraint, DateTime
+from sqlalchemy import Column, Enum, ForeignKey, Integer, Table, String, PrimaryKeyConstraint, DateTime, LargeBinary, \
+    Index, SmallInteger
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.orm import relationship, backref
 
@@ -13,6 +14,20 @@ class EnumRole(enum.Enum):
     admin = 'admin'
 
 
+class EnumJobStatus(enum.Enum):
+    pending = 'pending'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+
+
+class EnumSetStatus(enum.Enum):
+    normal = 'normal'
+    publishing = 'publishing'  # 后台写入 _1 的向量，完成后一次性设为公开
+    unpublishing = 'unpublishing'  # 已设为私有，后台清理 _1 的向量
+    deleting = 'deleting'  # 已不可见，后台分批删除
+
+
 class EnumPermission(enum.Enum):
     public = 'public'
     protected = 'protected'
@@ -30,13 +45,13 @@ class User(Base):
 set2user = Table('set2user',
                  Base.metadata,
                  Column('set_id', Integer, ForeignKey('question_set.id')),
-                 Column('user_id', Integer, ForeignKey('user.id')),
+                 Column('user_id', Integer, ForeignKey('user.id'), index=True),  # 按用户查权限
                  PrimaryKeyConstraint('set_id', 'user_id'))
 
 set2question = Table('set2question',
                      Base.metadata,
                      Column('set_id', Integer, ForeignKey('question_set.id')),
-                     Column('question_id', Integer, ForeignKey('question.id')),
+                     Column('question_id', Integer, ForeignKey('question.id'), index=True),  # 按问题查所属问题库
                      PrimaryKeyConstraint('set_id', 'question_id'))
 
 
@@ -45,7 +60,7 @@ class Question(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String(255), nullable=False)
     content = Column(String(3000), nullable=False)
-    embedding = Column(JSON, nullable=False)  # 好像实际上存的是 String?
+    embedding = Column(LargeBinary, nullable=False)  # float32 二进制，见 utils.vector；b'' 表示尚未编码
     modified_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
     modified_by_id = Column(Integer, ForeignKey('user.id'))
     modified_by = relationship('User', backref=backref('modified_question', lazy='dynamic'),
@@ -56,6 +71,20 @@ class Question(Base):
     created_by = relationship('User', backref=backref('created_question', lazy='dynamic'),
                               uselist=False, foreign_keys=[created_by_id])
 
+    # 列表页按 (modified_at, id) 倒序游标分页
+    __table_args__ = (Index('ix_question_modified_at_id', 'modified_at', 'id'),
+                      Index('ix_question_created_by_modified_at_id', 'created_by_id', 'modified_at', 'id'))
+
+
+# 关键词倒排索引：标题与内容的汉字二元组（标题另有单字）和英文/数字单词，见 utils.keyword
+question_gram = Table('question_gram',
+                      Base.metadata,
+                      Column('gram', String(32), nullable=False),
+                      Column('question_id', Integer, ForeignKey('question.id', ondelete='CASCADE'), nullable=False,
+                             index=True),
+                      Column('weight', SmallInteger, nullable=False),
+                      PrimaryKeyConstraint('gram', 'question_id'))
+
 
 class QuestionSet(Base):
     __tablename__ = 'question_set'
@@ -77,4 +106,35 @@ class QuestionSet(Base):
     created_by = relationship('User', backref=backref('created_set', lazy='dynamic'),
                               uselist=False, foreign_keys=[created_by_id])
     permission = Column(Enum(EnumPermission), server_default='private')
+    # 问题库内容每变化一次就加一，用于让查询缓存失效
+    generation = Column(Integer, nullable=False, default=0, server_default='0')
+    # 非 normal 时有后台任务正在处理，不接受新的成员或权限变化
+    status = Column(Enum(EnumSetStatus), nullable=False, default=EnumSetStatus.normal, server_default='normal')
     # passwd
+
+
+class EmbeddingStore(Base):
+    """按 sha256(模型, 标题, 内容) 保存编码结果，内容不变时不必再请求 RocketQA"""
+    __tablename__ = 'embedding_store'
+    key = Column(LargeBinary, primary_key=True)
+    embedding = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class Job(Base):
+    """后台任务，由 worker 进程（或 web 进程内联）认领执行"""
+    __tablename__ = 'job'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(64), nullable=False)
+    payload = Column(JSON, nullable=False)
+    status = Column(Enum(EnumJobStatus), nullable=False, default=EnumJobStatus.pending, index=True)
+    total = Column(Integer, nullable=False, default=0)
+    progress = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    run_at = Column(DateTime, default=datetime.now)  # 重试时推迟到这个时间之后
+    locked_until = Column(DateTime)  # 执行中的租约，过期后可被其他 worker 重新认领
+    checkpoint = Column(JSON)  # 分块任务已完成到的位置，重试时从这里继续
+    error = Column(String(3000))
+    modified_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    created_at = Column(DateTime, default=datetime.now)
+    created_by_id = Column(Integer, ForeignKey('user.id'))
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from fastapi import Query
 from pydantic import BaseModel
 
@@ -14,3 +16,6 @@ class HTTPError(BaseModel):
 class Pager(BaseModel):
     page: int = Query(default=1, ge=1)
     per_page: int = Query(default=10, ge=1)
+    cursor: Optional[str] = Query(default=None, description='上一页返回的 next_cursor，给出时忽略 page')
+    total: str = Query(default='exact', regex='^(exact|estimate|none)$',
+                       description='exact: 精确总数; estimate: 估计值; none: 不返回总数')
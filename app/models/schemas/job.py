@@ -0,0 +1,22 @@
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel
+
+from ..models import EnumJobStatus
+
+
+class JobDetail(BaseModel):
+    """后台任务的状态与进度"""
+    id: int
+    kind: str
+    status: EnumJobStatus
+    total: int
+    progress: int
+    attempts: int
+    error: Optional[str]
+    created_at: datetime
+    modified_at: datetime
+
+    class Config:
+        orm_mode = True
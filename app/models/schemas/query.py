@@ -0,0 +1,9 @@
+from typing import List
+
+from pydantic import BaseModel
+
+
+class BatchQuery(BaseModel):
+    """用于批量查询"""
+    queries: List[str]
+    set_id: int = 1
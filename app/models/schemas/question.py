@@ -40,6 +40,12 @@ class QuestionCreated(BaseModel):
         orm_mode = True
 
 
+class QuestionImported(BaseModel):
+    """CSV 导入后返回的信息，编码在后台进行"""
+    count: int
+    job_id: Optional[int] = None  # 通过 /api/job/{job_id} 查看编码进度
+
+
 class QuestionUpdate(BaseModel):
     """用于更新问题"""
     title: Optional[str]
@@ -58,9 +64,10 @@ class QuestionList(BaseModel):
 
 
 class QuestionListPage(BaseModel):
-    """分页后的列出问题"""
-    page: int = 1
+    """分页后的列出问题；游标分页时 page 为空，不计数时 total、pages 为空"""
+    page: Optional[int] = 1
     per_page: int = 10
-    total: int = 0
-    pages: int = 1
+    total: Optional[int] = 0
+    pages: Optional[int] = 1
     items: List[QuestionList] = []
+    next_cursor: Optional[str] = None  # 没有下一页时为空
@@ -5,7 +5,7 @@ from pydantic import BaseModel, validator
 from sqlalchemy.orm import Query
 
 from .user import UserName
-from ..models import EnumPermission
+from ..models import EnumPermission, EnumSetStatus
 
 
 class QuestionSetDetail(BaseModel):
@@ -21,6 +21,7 @@ class QuestionSetDetail(BaseModel):
     created_at: datetime
     created_by: UserName
     permission: EnumPermission
+    status: EnumSetStatus = EnumSetStatus.normal  # 非 normal 时后台任务正在处理
 
     # passwd
 
@@ -69,3 +70,16 @@ class QuestionSetUpdate(BaseModel):
     append_qids: Optional[List[int]]
     remove_qids: Optional[List[int]]
     permission: Optional[str]
+
+
+class QuestionSetUpdated(BaseModel):
+    """更新问题库后返回的信息，重复加入或移除不在库中的问题会被忽略"""
+    message: List[str] = []
+    appended: int = 0  # 实际新加入的问题数
+    removed: int = 0  # 实际移除的问题数
+    job_id: Optional[int] = None  # 设为公开/私有在后台进行，通过 /api/job/{job_id} 查看进度
+
+
+class QuestionSetDeleting(BaseModel):
+    """删除在后台分批进行，问题库立即不可见"""
+    job_id: int
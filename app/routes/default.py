@@ -1,16 +1,24 @@
+import asyncio
 import time
 from typing import Optional
 
 from fastapi import APIRouter
-from fastapi import Depends, Request, HTTPException, status, Response
+from fastapi import Depends, Request, HTTPException, status, Response, Query
 from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from starlette.status import HTTP_200_OK
 
-from ..dependencies import get_db, get_user
-from ..models.models import User, Question, QuestionSet
+from ..config import settings
+from ..dependencies import get_db, get_async_db, get_optional_user
+from ..models.models import User, Question, QuestionSet, EnumSetStatus, set2question
+from ..models.schemas.query import BatchQuery
 from ..models.schemas.question import QuestionListPage
-from ..utils import milvus, rocketqa, guardian, templates
+from ..utils import milvus, rocketqa, guardian, templates, query_cache, keyword
+from ..utils.metrics import query_degraded
+from ..utils.users import CurrentUser
 
 router = APIRouter()
 
@@ -28,15 +36,47 @@ def register(name: str, institution: Optional[str] = None, db: Session = Depends
     return Response(status_code=HTTP_200_OK)
 
 
-@router.get('/api/query')
-def get_query(query: str, set_id: int = 1, db: Session = Depends(get_db),
-              user_id: Optional[int] = Depends(get_user)):
-    return _query(query, set_id, db, user_id)
+@router.get('/api/query', description='mode=hybrid 时同时做关键词与向量检索并融合排序；'
+                                       '向量检索超时或失败时只返回关键词结果，并带上 X-Query-Degraded 响应头')
+async def get_query(response: Response, query: str, set_id: int = 1,
+                    mode: Optional[str] = Query(default=None, regex='^(vector|hybrid)$'),
+                    db: AsyncSession = Depends(get_async_db),
+                    user: Optional[CurrentUser] = Depends(get_optional_user)):
+    return await _query(query, set_id, db, user, mode or settings.query_mode, response)
+
+
+@router.post('/api/query/batch', description='批量查询，结果与 queries 顺序一致')
+async def batch_query(args: BatchQuery, db: AsyncSession = Depends(get_async_db),
+                      user: Optional[CurrentUser] = Depends(get_optional_user)):
+    if len(args.queries) > settings.batch_query_max_size:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'一次最多查询 {settings.batch_query_max_size} 个问题')
+    question_set = await _get_query_set(args.set_id, db, user)
+    outputs = [query_cache.get(question_set, query_str, 5) for query_str in args.queries]
+
+    # 短查询仍走关键词匹配，其余的一次编码、一次检索、一次 SQL
+    for i, query_str in enumerate(args.queries):
+        if outputs[i] is None and len(query_str) <= 4:
+            outputs[i] = await _keyword_query(db, question_set, query_str)
+            query_cache.put(question_set, query_str, 5, outputs[i])
+    pending = [i for i, output in enumerate(outputs) if output is None]
+    if not pending:
+        return outputs
+
+    embeddings = await rocketqa.async_get_embeddings([args.queries[i] for i in pending])
+    name = '_' + str(args.set_id)
+    hit_lists = await run_in_threadpool(_vector_batch_search, name, embeddings, 5, question_set.generation)
+    if hit_lists is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='向量检索失败')
+    for i, output in zip(pending, await _hydrate_many(db, question_set, hit_lists)):
+        outputs[i] = output
+        query_cache.put(question_set, args.queries[i], 5, output)
+    return outputs
 
 
 @router.get('/q/{query_str}', description='测试用，给机器人用着玩玩的')
-def q(query_str: str, db: Session = Depends(get_db)):
-    ret = _query(query_str, 1, db)
+async def q(query_str: str, db: AsyncSession = Depends(get_async_db)):
+    ret = await _query(query_str, 1, db)
     a = '<html><body><div>'
     for ans in ret:
         a += '<h3>' + ans['title'] + '</h3>\n'
@@ -45,42 +85,147 @@ def q(query_str: str, db: Session = Depends(get_db)):
     return a
 
 
-def _query(query_str: str, set_id: int, db: Session, user_id: Optional[int] = None):
-    question_set = db.query(QuestionSet).get(set_id)
-    if not guardian.can_get_question_set(db.query(User).get(user_id), question_set):
-        if user_id is None:
-            raise HTTPException(status_code=status.HTTP_403_UNAUTHORIZED, detail="Please login")
+async def _get_query_set(set_id: int, db: AsyncSession, user: Optional[CurrentUser]):
+    question_set = await db.get(QuestionSet, set_id)
+    if question_set is None or question_set.status == EnumSetStatus.deleting:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='QuestionSet not found')
+    # guardian 通过同步 Session 查询权限，需要在 run_sync 里执行
+    if not await db.run_sync(lambda session: guardian.can_get_question_set(session, user, question_set)):
+        if user is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Please login")
         else:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
-    if len(query_str) <= 4:
-        questions = question_set.questions.filter(Question.title.like(f'%{query_str}%')).limit(5).all()
+    return question_set
+
+
+async def _keyword_query(db: AsyncSession, question_set: QuestionSet, query_str: str, top_k=5):
+    """关键词倒排索引检索，按相关度排序"""
+    ranking = keyword.ranked(question_set.id, query_str)
+    if ranking is None:
+        return []
+    stmt = select(Question.id, Question.title, Question.content) \
+        .join(ranking, ranking.c.question_id == Question.id) \
+        .order_by(ranking.c.matched.desc(), ranking.c.score.desc(), Question.id.desc()).limit(top_k)
+    output = []
+    for question in (await db.execute(stmt)).all():
+        output.append({'id': question.id, 'title': question.title, 'content': question.content})
+    return output
+
+
+async def _hydrate_many(db: AsyncSession, question_set: QuestionSet, hit_lists):
+    """一次查询取回多组 milvus 命中的问题，每组保持 milvus 的排序。
+
+    只保留当前仍属于问题库的问题：已删除、已移出，或后台任务已写入 milvus 但尚未切换可见的 id 直接跳过
+    """
+    qids = {hit.id for hits in hit_lists for hit in hits}
+    rows = (await db.execute(select(Question.id, Question.title, Question.content)
+                             .join(set2question, set2question.c.question_id == Question.id)
+                             .where(set2question.c.set_id == question_set.id, Question.id.in_(qids)))).all()
+    found = {row.id: row for row in rows}
+    outputs = []
+    for hits in hit_lists:
         output = []
-        for question in questions:
-            output.append({'title': question.title, 'content': question.content})
+        for hit in hits:
+            row = found.get(hit.id)
+            if row is None:
+                continue
+            output.append({'id': row.id, 'title': row.title, 'content': row.content, 'distance': hit.distance})
+        outputs.append(output)
+    return outputs
+
+
+async def _hydrate(db: AsyncSession, question_set: QuestionSet, hits):
+    return (await _hydrate_many(db, question_set, [hits]))[0]
+
+
+def _vector_search(name, embedding, top_k, version):
+    return milvus.search(name, embedding, top_k, version=version, params=milvus.search_params(name, top_k))
+
+
+def _vector_batch_search(name, embeddings, top_k, version):
+    return milvus.batch_search(name, embeddings, top_k, version=version, params=milvus.search_params(name, top_k))
+
+
+async def _vector_hits(question_set: QuestionSet, query_str: str, top_k):
+    embedding = await rocketqa.async_get_embedding(query_str)
+    return await run_in_threadpool(_vector_search, '_' + str(question_set.id), embedding, top_k,
+                                   question_set.generation)
+
+
+def _rrf(result_lists, top_k):
+    """Reciprocal Rank Fusion：每一路按名次给分 1 / (k + rank)，相加后排序；同一问题保留先出现的那一项"""
+    scores, items = {}, {}
+    for results in result_lists:
+        for rank, item in enumerate(results, 1):
+            scores[item['id']] = scores.get(item['id'], 0) + 1 / (settings.query_rrf_k + rank)
+            items.setdefault(item['id'], item)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [dict(items[qid], score=scores[qid]) for qid in ranked]
+
+
+async def _hybrid_query(db: AsyncSession, question_set: QuestionSet, query_str: str, top_k):
+    """关键词与向量检索并发执行；向量检索在 query_latency_budget 内完成时融合两路结果，
+    否则只返回关键词结果。返回 (结果, 降级原因或 None)"""
+    deadline = time.monotonic() + settings.query_latency_budget
+    # 向量检索不使用 db，可以与关键词检索的 SQL 同时进行
+    vector_task = asyncio.create_task(_vector_hits(question_set, query_str, top_k))
+    try:
+        keyword_output = await _keyword_query(db, question_set, query_str, top_k)
+        try:
+            hits = await asyncio.wait_for(vector_task, max(deadline - time.monotonic(), 0))
+            degraded = 'error' if hits is None else None
+        except asyncio.TimeoutError:
+            degraded = 'timeout'
+        except Exception as e:
+            logger.warning('Vector retrieval failed: {}', e)
+            degraded = 'error'
+    finally:
+        if not vector_task.done():
+            vector_task.cancel()
+    if degraded:
+        query_degraded.labels(degraded).inc()
+        return keyword_output, degraded
+    return _rrf([await _hydrate(db, question_set, hits), keyword_output], top_k), None
+
+
+async def _query(query_str: str, set_id: int, db: AsyncSession, user: Optional[CurrentUser] = None,
+                 mode: str = 'vector', response: Optional[Response] = None):
+    # 数据库与编码都是异步的；milvus 仍是同步调用，放到线程池里
+    question_set = await _get_query_set(set_id, db, user)
+    output = query_cache.get(question_set, query_str, 5, mode)
+    if output is not None:
+        return output
+    if len(query_str) <= 4:
+        output = await _keyword_query(db, question_set, query_str)
+        query_cache.put(question_set, query_str, 5, output, mode)
+        return output
+
+    if mode == 'hybrid':
+        output, degraded = await _hybrid_query(db, question_set, query_str, 5)
+        if degraded:
+            if response is not None:
+                response.headers['X-Query-Degraded'] = degraded
+            return output  # 降级的结果不缓存
+        query_cache.put(question_set, query_str, 5, output, mode)
         return output
 
     start = time.time()
-    embedding = rocketqa.get_embedding(query_str)
+    embedding = await rocketqa.async_get_embedding(query_str)
     end = time.time()
     logger.debug('feature extract time: {}s', end - start)
 
     start = time.time()
 
     name = '_' + str(set_id)
-    search_status, search_result = milvus.search(name, embedding, 5)
-    qids = []
-    if not search_result:
+    hits = await run_in_threadpool(_vector_search, name, embedding, 5, question_set.generation)
+    if hits is None:
         return {'message': "I'm a teapot"}, 418
-    for each_distance in search_result[0]:
-        qids.append(each_distance.id)
     end = time.time()
     logger.debug('search time: {}s', end - start)
 
     start = time.time()
-    output = []
-    for qid in qids:
-        question = db.query(Question).get(qid)
-        output.append({'title': question.title, 'content': question.content})
+    output = await _hydrate(db, question_set, hits)
     end = time.time()
     logger.debug('sql time: {}s', end - start)
+    query_cache.put(question_set, query_str, 5, output)
     return output
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+
+from ..dependencies import get_db, get_current_user
+from ..models.models import Job, EnumRole
+from ..models.schemas import HTTPError
+from ..models.schemas.job import JobDetail
+from ..utils.users import CurrentUser
+
+router = APIRouter(
+    prefix='/api/job',
+    tags=['job'],
+    responses={401: {'model': HTTPError}, 403: {'model': HTTPError}}
+)
+
+
+@router.get('/{job_id}', response_model=JobDetail, responses={404: {'model': HTTPError}})
+def get_job(job_id: int, db: Session = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
+    job = db.query(Job).get(job_id)
+    if job:
+        if job.created_by_id != user.id and user.role != EnumRole.admin:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
+        return job
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job not found')
@@ -1,20 +1,27 @@
+import codecs
 import csv
-import json
 import time
-from io import StringIO
-from typing import Optional, List
+from itertools import islice
+from typing import Optional
 
 from fastapi import APIRouter, Depends, HTTPException, status, Response, UploadFile,BackgroundTasks
 from loguru import logger
-from sqlalchemy.orm import Session
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, defer, joinedload
+from starlette.concurrency import run_in_threadpool
 from starlette.status import HTTP_200_OK
 
-from ..dependencies import get_db, get_logged_user
-from ..models.models import Question, QuestionSet, User, EnumRole, EnumPermission
+from ..config import settings
+from ..dependencies import get_db, get_async_db, get_current_user
+from ..models.models import Question, QuestionSet, EnumRole, EnumSetStatus, EnumPermission, set2question
 from ..models.schemas import HTTPError, Pager
-from ..models.schemas.question import QuestionDetail, QuestionUpdate, QuestionListPage, QuestionCreate, QuestionCreated
-from ..utils import milvus, rocketqa, guardian, background_rocketqa
+from ..models.schemas.question import QuestionDetail, QuestionUpdate, QuestionListPage, QuestionCreate, QuestionCreated, \
+    QuestionImported
+from ..utils import guardian, background_rocketqa, query_cache, vector, jobs, keyword, embedding_store, membership
 from ..utils.database import SessionLocal
+from ..utils.pagination import async_paginate, async_keyset_paginate
+from ..utils.users import CurrentUser
 
 router = APIRouter(
     prefix='/api/question',
@@ -23,168 +30,201 @@ router = APIRouter(
 )
 
 
+def _list_stmt():
+    # 列表页只需要 modified_by，且不加载向量
+    return select(Question).options(defer(Question.embedding), joinedload(Question.modified_by))
+
+
+def _in_set(stmt, sid):
+    return stmt.join(set2question, set2question.c.question_id == Question.id).where(set2question.c.set_id == sid)
+
+
+async def _paginate(db: AsyncSession, stmt, keys, pager: Pager):
+    """有 cursor 时按 keys 做游标分页，否则沿用页码分页"""
+    questions = QuestionListPage()
+    try:
+        if pager.cursor:
+            page = await async_keyset_paginate(db, stmt, keys, pager.cursor, pager.per_page, pager.total)
+        else:
+            page = await async_paginate(db, stmt, pager.page, pager.per_page, pager.total, keys)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='无效的 cursor')
+    page.update(questions)
+    return questions
+
+
 @router.get('/', response_model=QuestionListPage, responses={404: {'model': HTTPError}},
-            description='无sid: 返回用户创建的问题（admin可获取所有问题）\n\n'
-                        '有sid: 返回问题库内的问题')
-def get_questions(sid: Optional[int] = None, pager: Pager = Depends(),
-                  db: Session = Depends(get_db), user_id: int = Depends(get_logged_user)):
-    user = db.query(User).get(user_id)
+            description='无sid: 返回用户创建的问题（admin可获取所有问题），按修改时间倒序\n\n'
+                        '有sid: 返回问题库内的问题，按 id 倒序\n\n'
+                        '深翻页请使用 next_cursor')
+async def get_questions(sid: Optional[int] = None, pager: Pager = Depends(),
+                        db: AsyncSession = Depends(get_async_db), user: CurrentUser = Depends(get_current_user)):
     if sid is None:
         if user.role == EnumRole.admin:
-            query = db.query(Question)
+            stmt = _list_stmt()
         else:
-            query = user.created_question
+            stmt = _list_stmt().where(Question.created_by_id == user.id)
+        keys = (Question.modified_at, Question.id)
     else:
-        question_set = db.query(QuestionSet).get(sid)
+        question_set = await db.get(QuestionSet, sid)
         if question_set:
-            if not guardian.can_get_question_set(user, question_set):
+            if not await db.run_sync(lambda session: guardian.can_get_question_set(session, user, question_set)):
                 raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
-            query = question_set.questions
+            stmt = _in_set(_list_stmt(), sid)
+            keys = (Question.id,)  # 沿 set2question 主键顺序读取
         else:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='QuestionSet not found')
-    questions = QuestionListPage()
-    query.paginate(pager.page, pager.per_page).update(questions)
-    return questions
+    return await _paginate(db, stmt, keys, pager)
+
+
+def _check_create(db: Session, user: CurrentUser, sid: Optional[int]) -> bool:
+    """检查能否创建问题并加入 sid 问题库，返回该问题库是否公开"""
+    if not guardian.can_create_question(user):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
+    if not sid:
+        return False
+    qs = db.query(QuestionSet).get(sid)
+    if qs is None or qs.status == EnumSetStatus.deleting:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='QuestionSet not found')
+    if not guardian.can_modify_question_set(db, user, qs):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
+    return qs.permission == EnumPermission.public
 
 
 @router.post('/', response_model=QuestionCreated, status_code=status.HTTP_201_CREATED)
-async def create_question(args: QuestionCreate, user_id: int = Depends(get_logged_user)):
-    with SessionLocal() as db:
-        user = db.query(User).get(user_id)
-        if not guardian.can_create_question(user):
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
-        if args.sid:
-            qs = db.query(QuestionSet).get(args.sid)
-            if qs is None:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='QuestionSet not found')
-            if not guardian.can_modify_question_set(user, qs):
-                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
+def create_question(args: QuestionCreate, db: Session = Depends(get_db),
+                    user: CurrentUser = Depends(get_current_user)):
+    public = _check_create(db, user, args.sid)
     title, content = args.title, args.content
-    emb_array = await rocketqa.async_get_para(title, content)
-    embedding = json.dumps(emb_array)  # dumps 只出现在了这里
+    embedding = embedding_store.get_para(db, title, content)
+    question = Question(title=title, content=content, embedding=embedding)
+    question.created_by_id = user.id
+    question.modified_by_id = user.id
+    db.add(question)
+    db.flush()
+    keyword.index_questions(db, [(question.id, title, content)], replace=False)
+    if args.sid:
+        qs = db.query(QuestionSet).get(args.sid)
+        start = time.time()
+        qs.questions.append(question)
+        qs.modified_by_id = user.id
+        if public:
+            public_set = db.query(QuestionSet).get(1)
+            public_set.questions.append(question)
+
+        db.flush()
+
+        end = time.time()
+        logger.debug('sql time: {}s', end - start)
+
+        # 按成员关系与问题库状态写入，正在公开的问题库同样写 _1
+        sids = membership.write_vectors(db, [question.id], vector.stack([embedding]))
+
+        end2 = time.time()
+        logger.debug('milvus time: {}s', end2 - end)
+        query_cache.invalidate(db, sids)
+    db.commit()
+    return QuestionCreated.from_orm(question)
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _import_csv(file, sid: Optional[int], public: bool, user_id: int):
+    """逐行解析 CSV，每 import_chunk_size 行批量插入并提交一次，不在内存中保留整个文件。
+
+    编码任务先以 hold 状态建立，每块提交时扩大任务的 id 范围，导入结束后才放行；返回导入的问题数和任务 id。
+    任务内容只记录 id 范围，大小不随文件增长。
+    """
+    # UploadFile.file 是 SpooledTemporaryFile，不能套 TextIOWrapper，按行增量解码
+    reader = csv.DictReader(codecs.iterdecode(file, 'utf-8'))
+    payload, count = {'user_id': user_id, 'first_id': None, 'last_id': None}, 0
     with SessionLocal() as db:
-        question = Question(title=title, content=content, embedding=embedding)
-        question.created_by_id = user_id
-        question.modified_by_id = user_id
-        db.add(question)
-        if args.sid:
-            db.flush()
-            qs = db.query(QuestionSet).get(args.sid)
-            public = qs.permission == EnumPermission.public
-            start = time.time()
-            qs.questions.append(question)
-            qs.modified_by_id = user_id
-            if public:
-                public_set = db.query(QuestionSet).get(1)
-                public_set.questions.append(question)
-
-            db.flush()
-
-            end = time.time()
-            logger.debug('sql time: {}s', end - start)
-
-            milvus.insert('_' + str(args.sid), [emb_array], [question.id])
-            if public:
-                milvus.insert('_1', [emb_array], [question.id])
-
-            end2 = time.time()
-            logger.debug('milvus time: {}s', end2 - end)
+        job_id = jobs.enqueue(db, 'encode_questions', payload, user_id=user_id, hold=True).id
         db.commit()
-        question = QuestionCreated.from_orm(question)
-        return question
+        try:
+            for rows in _chunked(reader, settings.import_chunk_size):
+                values = [{'title': row['title'], 'content': row['content'], 'embedding': b'',
+                           'created_by_id': user_id, 'modified_by_id': user_id} for row in rows]
+                qids = db.execute(insert(Question).values(values).returning(Question.id)).scalars().all()
+                keyword.index_questions(db, [(qid, row['title'], row['content']) for qid, row in zip(qids, rows)],
+                                        replace=False)
+                if sid:
+                    links = [{'set_id': sid, 'question_id': qid} for qid in qids]
+                    if public:
+                        links += [{'set_id': 1, 'question_id': qid} for qid in qids]
+                    db.execute(insert(set2question).values(links))
+                    db.query(QuestionSet).filter(QuestionSet.id == sid) \
+                        .update({QuestionSet.modified_by_id: user_id}, synchronize_session=False)
+                    query_cache.invalidate(db, [sid], public)
+                if payload['first_id'] is None:
+                    payload['first_id'] = min(qids)
+                payload['last_id'] = max(qids)
+                count += len(qids)
+                jobs.hold(db, job_id, payload, count)
+                db.commit()
+        except (KeyError, UnicodeDecodeError, csv.Error) as e:
+            logger.info('Cannot read csv after {} rows: {}', count, e)
+            detail = f'Cannot read file, {count} questions imported' if count else 'Cannot read file'
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+        finally:
+            # 出错时已提交的块照常编码
+            db.rollback()
+            jobs.release(db, job_id)
+            db.commit()
+    return count, job_id
 
 
-@router.post('/csv', response_model=List[QuestionCreated], status_code=status.HTTP_202_ACCEPTED)
+@router.post('/csv', response_model=QuestionImported, status_code=status.HTTP_202_ACCEPTED)
 async def create_questions(file: UploadFile, background_tasks: BackgroundTasks,
-                           sid: Optional[int] = None, user_id: int = Depends(get_logged_user)):
-    with SessionLocal() as db:
-        user = db.query(User).get(user_id)
-        if not guardian.can_create_question(user):
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
-        if sid:
-            qs = db.query(QuestionSet).get(sid)
-            if qs is None:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='QuestionSet not found')
-            if not guardian.can_modify_question_set(user, qs):
-                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
-    titles = []
-    contents = []
+                           sid: Optional[int] = None, user: CurrentUser = Depends(get_current_user)):
+    def check():
+        with SessionLocal() as db:
+            return _check_create(db, user, sid)
+
+    public = await run_in_threadpool(check)
+    start = time.time()
     try:
-        content = await file.read()
-        read_csv = csv.DictReader(StringIO(content.decode('utf-8')))
-        for q in read_csv:
-            titles.append(q['title'])
-            contents.append(q['content'])
-    except Exception as e:
-        print(e)
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Cannot read file')
+        count, job_id = await run_in_threadpool(_import_csv, file.file, sid, public, user.id)
     finally:
         await file.close()
-    questions = []
-    logger.debug(titles)
-    logger.debug(contents)
-    # emb_arrays = await rocketqa.async_get_paras(titles, contents)
-    logger.debug('rocketqa ok')
-    with SessionLocal() as db:
-        # for i, emb_array in enumerate(emb_arrays):
-        for title, content in zip(titles, contents):
-            question = Question(title=title, content=content)
-            # embedding = json.dumps(emb_array)
-            question.embedding = ''
-            question.created_by_id = user_id
-            question.modified_by_id = user_id
-            questions.append(question)
-        db.add_all(questions)
-        if sid:
-            db.flush()
-            qs = db.query(QuestionSet).get(sid)
-            public = qs.permission == EnumPermission.public
-            start = time.time()
-            qs.questions.extend(questions)
-            qs.modified_by_id = user_id
-            if public:
-                public_set = db.query(QuestionSet).get(1)
-                public_set.questions.extend(questions)
-
-            db.flush()
-
-            end = time.time()
-            logger.debug('sql time: {}s', end - start)
-
-            # qids = [question.id for question in questions]
-            # milvus.insert('_' + str(sid), emb_arrays, qids)
-            # if public:
-            #     milvus.insert('_1', emb_arrays, qids)
-
-            # end2 = time.time()
-            # logger.debug('milvus time: {}s', end2 - end)
-        db.commit()
-        background_tasks.add_task(background_rocketqa.create, titles, contents, questions, sid, public)
-        return [QuestionCreated.from_orm(question) for question in questions]
+    logger.debug('csv import time: {}s', time.time() - start)
+    if not settings.job_worker:
+        background_tasks.add_task(jobs.run_inline, job_id)
+    return QuestionImported(count=count, job_id=job_id)
 
 
 @router.get('/search', response_model=QuestionListPage, responses={404: {'model': HTTPError}},
-            description='关键词搜索')
-def search_questions(sid: int, text: str, pager: Pager = Depends(),
-                     db: Session = Depends(get_db), user_id: int = Depends(get_logged_user)):
-    user = db.query(User).get(user_id)
-    question_set = db.query(QuestionSet).get(sid)
+            description='关键词搜索标题与内容，按相关度排序')
+async def search_questions(sid: int, text: str, pager: Pager = Depends(),
+                           db: AsyncSession = Depends(get_async_db), user: CurrentUser = Depends(get_current_user)):
+    question_set = await db.get(QuestionSet, sid)
     if question_set:
-        if not guardian.can_get_question_set(user, question_set):
+        if not await db.run_sync(lambda session: guardian.can_get_question_set(session, user, question_set)):
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
-        query = question_set.questions.filter(Question.title.like(f'%{text}%'))
     else:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='QuestionSet not found')
-    questions = QuestionListPage()
-    query.paginate(pager.page, pager.per_page).update(questions)
-    return questions
+    ranking = keyword.ranked(sid, text)
+    if ranking is None:  # 只有标点等无法检索的字符
+        return QuestionListPage(total=0, pages=0)
+    stmt = _list_stmt().join(ranking, ranking.c.question_id == Question.id)
+    return await _paginate(db, stmt, (ranking.c.matched, ranking.c.score, Question.id), pager)
 
 
 @router.get('/{qid}', response_model=QuestionDetail, responses={404: {'model': HTTPError}})
-def get_question(qid: int, db: Session = Depends(get_db), user_id: int = Depends(get_logged_user)):
-    question = db.query(Question).get(qid)
+async def get_question(qid: int, db: AsyncSession = Depends(get_async_db),
+                       user: CurrentUser = Depends(get_current_user)):
+    question = await db.get(Question, qid, options=[defer(Question.embedding),
+                                                    joinedload(Question.modified_by),
+                                                    joinedload(Question.created_by)])
     if question:
-        if not guardian.can_get_question(db.query(User).get(user_id), question):
+        if not await db.run_sync(lambda session: guardian.can_get_question(session, user, question)):
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
         return question
     else:
@@ -193,43 +233,42 @@ def get_question(qid: int, db: Session = Depends(get_db), user_id: int = Depends
 
 @router.put('/{qid}', response_model=QuestionDetail, responses={404: {'model': HTTPError}})
 def update_question(qid: int, args: QuestionUpdate, db: Session = Depends(get_db),
-                    user_id: int = Depends(get_logged_user)):
+                    user: CurrentUser = Depends(get_current_user)):
     question = db.query(Question).get(qid)
     if question:
-        if not guardian.can_modify_question(db.query(User).get(user_id), question):
+        if not guardian.can_modify_question(db, user, question):
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
-        if args.title:
-            question.title = args.title
-            title = args.title
-        else:
-            title = question.title
-        if args.content:
-            question.content = args.content
-            content = args.content
-        else:
-            content = question.content
-        embedding = rocketqa.get_para(title, content)
-        question.embedding = json.dumps(embedding)
-        question.modified_by_id = user_id
+        title = args.title or question.title
+        content = args.content or question.content
+        question.modified_by_id = user.id
+        if title == question.title and content == question.content and question.embedding:
+            # 内容没有变化，不需要重新编码与更新索引
+            db.commit()
+            db.refresh(question)
+            return question
+        question.title = title
+        question.content = content
+        question.embedding = embedding_store.get_para(db, title, content)
+        keyword.index_questions(db, [(qid, title, content)])
+        db.flush()  # UPDATE 锁住问题行后再读成员关系
+        # 包括公开任务已经写入 _1 的旧向量
+        sids = membership.write_vectors(db, [qid], vector.stack([question.embedding]), replace=True)
+        query_cache.invalidate(db, sids)
         db.commit()
         db.refresh(question)
-        for sid in question.belongs.with_entities(QuestionSet.id).all():
-            collection_name = '_' + str(sid[0])
-            milvus.delete(collection_name, [qid])
-            milvus.insert(collection_name, [embedding], [qid])
         return question
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Question not found')
 
 
 @router.delete('/{qid}', responses={404: {'model': HTTPError}})
-def delete_question(qid: int, db: Session = Depends(get_db), user_id: int = Depends(get_logged_user)):
+def delete_question(qid: int, db: Session = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
     question = db.query(Question).get(qid)
     if question:
-        if not guardian.can_delete_question(db.query(User).get(user_id), question):
+        if not guardian.can_delete_question(db, user, question):
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
-        for sid in question.belongs.with_entities(QuestionSet.id).all():
-            collection_name = '_' + str(sid[0])
-            milvus.delete(collection_name, [qid])
+        sids, names, _ = membership.targets(db, [qid])
+        membership.drop_vectors(list(names), [qid])
+        query_cache.invalidate(db, sids)
         db.delete(question)
         db.commit()
         return Response(status_code=HTTP_200_OK)
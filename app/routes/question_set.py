@@ -1,18 +1,22 @@
-import json
 import time
 from typing import List
 
-from fastapi import APIRouter, Depends, HTTPException, status, Response
+from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
 from loguru import logger
+from sqlalchemy import select, insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from starlette.status import HTTP_200_OK
 
-from ..dependencies import get_db, get_logged_user
-from ..models.models import QuestionSet, Question, User, EnumRole, EnumPermission
+from ..config import settings
+from ..dependencies import get_db, get_async_db, get_current_user
+from ..models.models import QuestionSet, Question, EnumRole, EnumPermission, EnumSetStatus, set2question, \
+    set2user
 from ..models.schemas import HTTPError
 from ..models.schemas.question_set import QuestionSetDetail, QuestionSetUpdate, QuestionSetList, QuestionSetCreate, \
-    QuestionSetCreated
-from ..utils import milvus, guardian
+    QuestionSetCreated, QuestionSetUpdated, QuestionSetDeleting
+from ..utils import milvus, guardian, query_cache, membership, jobs
+from ..utils import background_question_set  # noqa 注册任务处理函数
+from ..utils.users import CurrentUser
 
 router = APIRouter(
     prefix='/api/question_set',
@@ -22,174 +26,154 @@ router = APIRouter(
 
 
 @router.get('/{sid}', response_model=QuestionSetDetail, responses={404: {'model': HTTPError}})
-def get_question_set(sid: int, db: Session = Depends(get_db), user_id: int = Depends(get_logged_user)):
-    question_set = db.query(QuestionSet).get(sid)
-    if question_set:
-        if not guardian.can_get_question_set(db.query(User).get(user_id), question_set):
+async def get_question_set(sid: int, db: AsyncSession = Depends(get_async_db),
+                           user: CurrentUser = Depends(get_current_user)):
+    question_set = await db.get(QuestionSet, sid)
+    if question_set and question_set.status != EnumSetStatus.deleting:
+        if not await db.run_sync(lambda session: guardian.can_get_question_set(session, user, question_set)):
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
-        ret_set = QuestionSetDetail.from_orm(question_set)
-        ret_set.question_ids = [qid[0] for qid in question_set.questions.with_entities(Question.id).all()]
+        # from_orm 会懒加载 owner、maintainer 等，需要在 run_sync 里执行
+        ret_set = await db.run_sync(lambda _: QuestionSetDetail.from_orm(question_set))
+        ret_set.question_ids = (await db.execute(select(set2question.c.question_id)
+                                                 .where(set2question.c.set_id == sid))).scalars().all()
         return ret_set
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='QuestionSet not found')
 
 
-@router.put('/{sid}', responses={404: {'model': HTTPError}, 400: {'model': HTTPError}})
-def update_question_set(sid: int, args: QuestionSetUpdate, db: Session = Depends(get_db),
-                        user_id: int = Depends(get_logged_user)):
-    append_qids = args.append_qids
-    remove_qids = args.remove_qids
+@router.put('/{sid}', response_model=QuestionSetUpdated, responses={404: {'model': HTTPError}, 400: {'model': HTTPError}})
+def update_question_set(sid: int, args: QuestionSetUpdate, background_tasks: BackgroundTasks,
+                        db: Session = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
+    append_qids = set(args.append_qids or [])
+    remove_qids = set(args.remove_qids or [])
 
     qs = db.query(QuestionSet).get(sid)
-    if qs is None:
+    if qs is None or qs.status == EnumSetStatus.deleting:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='QuestionSet not found')
 
-    if not guardian.can_modify_question_set(db.query(User).get(user_id), qs):
+    if not guardian.can_modify_question_set(db, user, qs):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
+    if qs.status != EnumSetStatus.normal:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='问题库正在后台处理，请稍后再试')
 
     public = qs.permission == EnumPermission.public
+    name = '_' + str(sid)
+    # 只在 milvus 中另存公开库副本时才需要写 _1
+    public_names = ['_1'] if milvus.stores_public_copy else []
 
-    message = []
+    result = QuestionSetUpdated()
 
+    # 成员变化都是对 set2question 的整体 INSERT ... ON CONFLICT / DELETE，再按实际变化的 id 批量写 milvus
     if append_qids:
         start = time.time()
-        questions = db.query(Question).filter(Question.id.in_(append_qids)).all()
-        if len(append_qids) != len(questions):
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='问题ID有错误')
-        qs.questions.extend(questions)
-        qs.modified_by_id = user_id
-        if public:
-            public_set = db.query(QuestionSet).get(1)
-            public_set.questions.extend(questions)
-        try:
-            db.flush()
-        except Exception as e:
-            logger.debug(e)
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='不要重复插入问题')
-
-        embeddings = [json.loads(question.embedding) for question in questions]
-        append_qids = [question.id for question in questions]  # 为了顺序对应，重新生成qids
-
+        # 只能加入自己可读的问题，一条语句检查全部 id
+        if guardian.readable_questions(db, user, append_qids) != append_qids:
+            if db.query(Question.id).filter(Question.id.in_(append_qids)).count() != len(append_qids):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='问题ID有错误')
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
+        added = membership.add(db, sid, append_qids)
+        published = membership.publish(db, sid, added) if public else []
         end = time.time()
         logger.debug('sql time: {}s', end - start)
 
-        milvus.insert('_' + str(sid), embeddings, append_qids)
-        if public:
-            milvus.insert('_1', embeddings, append_qids)
-
-        end2 = time.time()
-        logger.debug('milvus time: {}s', end2 - end)
-        message.append('问题库增加问题')
+        membership.push_vectors(db, [name], added)
+        membership.push_vectors(db, public_names, published)
+        logger.debug('milvus time: {}s', time.time() - end)
+        result.appended = len(added)
+        result.message.append('问题库增加问题')
 
     if remove_qids:
-        questions = db.query(Question).filter(Question.id.in_(remove_qids)).all()
-        if len(remove_qids) != len(questions):
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='问题ID有错误')
-        for question in questions:
-            qs.questions.remove(question)
-        qs.modified_by_id = user_id
-        if public:
-            public_set = db.query(QuestionSet).get(1)
-            for question in questions:
-                public_set.questions.remove(question)
-        try:
-            db.flush()
-        except Exception as e:
-            logger.debug(e)
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='未插入的问题')
-
-        milvus.delete('_' + str(sid), remove_qids)
-        if public:
-            milvus.delete('_1', remove_qids)
-        message.append('问题库移除问题')
+        removed = membership.remove(db, sid, remove_qids)
+        unpublished = membership.unpublish(db, sid, removed) if public and removed else []
+        membership.drop_vectors([name], removed)
+        membership.drop_vectors(public_names, unpublished)
+        result.removed = len(removed)
+        result.message.append('问题库移除问题')
 
     if args.name:
         qs.name = args.name
-        qs.modified_by_id = user_id
-        db.flush()
-        message.append('问题库更名')
+        result.message.append('问题库更名')
 
     if args.description:
         qs.description = args.description
-        qs.modified_by_id = user_id
-        db.flush()
-        message.append('问题库更改描述')
+        result.message.append('问题库更改描述')
 
+    # 大问题库的 _1 向量写入/清理在后台分块进行，完成（公开）或开始（私有）时一次性切换 permission
     if args.permission == EnumPermission.public.value:
         if qs.permission != EnumPermission.public:
-            qs.permission = EnumPermission.public
-            qs.modified_by_id = user_id
-            public_set = db.query(QuestionSet).get(1)
-            questions = qs.questions
-            public_set.questions.extend(questions)
-            db.flush()
-
-            embeddings = [json.loads(question.embedding) for question in questions]
-            qids = [question.id for question in questions]
-            milvus.insert('_1', embeddings, qids)
-            message.append('设为公开')
+            result.job_id = _start_job(db, qs, EnumSetStatus.publishing, 'publish_question_set', user).id
+            result.message.append('设为公开')
 
     if args.permission == EnumPermission.private.value:
         if qs.permission != EnumPermission.private:
-            qs.permission = EnumPermission.private
-            qs.modified_by_id = user_id
-            public_set = db.query(QuestionSet).get(1)
-            questions = qs.questions
-            for question in questions:
-                public_set.questions.remove(question)
-            db.flush()
-
-            qids = [question.id for question in questions]
-            milvus.delete('_1', qids)
-            message.append('设为私有')
+            result.job_id = _start_job(db, qs, EnumSetStatus.unpublishing, 'unpublish_question_set', user).id
+            result.message.append('设为私有')
 
     # add maintainer
     # change owner
-    if len(message) == 0:
+    if len(result.message) == 0:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='无法理解的操作')
-    else:
-        db.commit()
-        return Response(status_code=HTTP_200_OK)
+    qs.modified_by_id = user.id
+    if result.appended or result.removed:
+        query_cache.invalidate(db, [sid], public)
+    db.commit()
+    if result.job_id is not None and not settings.job_worker:
+        background_tasks.add_task(jobs.run_inline, result.job_id)
+    return result
+
+
+def _start_job(db: Session, qs: QuestionSet, set_status: EnumSetStatus, kind, user: CurrentUser, **payload):
+    """标记问题库正在处理并新建后台任务，由调用者 commit"""
+    qs.status = set_status
+    total = db.query(set2question).filter(set2question.c.set_id == qs.id).count()
+    return jobs.enqueue(db, kind, dict(payload, sid=qs.id), total=total, user_id=user.id)
 
 
-@router.delete('/{sid}', responses={404: {'model': HTTPError}})
-def delete_question_set(sid: int, db: Session = Depends(get_db), user_id: int = Depends(get_logged_user)):
+@router.delete('/{sid}', response_model=QuestionSetDeleting, status_code=status.HTTP_202_ACCEPTED,
+               responses={404: {'model': HTTPError}, 409: {'model': HTTPError}})
+def delete_question_set(sid: int, background_tasks: BackgroundTasks, db: Session = Depends(get_db),
+                        user: CurrentUser = Depends(get_current_user)):
     question_set = db.query(QuestionSet).get(sid)
-    if question_set:
-        if not guardian.can_delete_question_set(db.query(User).get(user_id), question_set):
+    if question_set and question_set.status != EnumSetStatus.deleting:
+        if not guardian.can_delete_question_set(db, user, question_set):
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
-        milvus.drop_collection('_' + str(question_set.id))
-        db.delete(question_set)
+        if question_set.status != EnumSetStatus.normal:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='问题库正在后台处理，请稍后再试')
+        # 标记后立即不可见，成员关系与向量在后台分批删除
+        job = _start_job(db, question_set, EnumSetStatus.deleting, 'delete_question_set', user,
+                         public=question_set.permission == EnumPermission.public)
         db.commit()
-        return Response(status_code=HTTP_200_OK)
+        if not settings.job_worker:
+            background_tasks.add_task(jobs.run_inline, job.id)
+        return QuestionSetDeleting(job_id=job.id)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='QuestionSet not found')
 
 
 @router.get('/', response_model=List[QuestionSetList])
-def get_question_sets(db: Session = Depends(get_db), user_id: int = Depends(get_logged_user)):
-    user = db.query(User).get(user_id)
-    if not user:
-        return []  # return public
+def get_question_sets(db: Session = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
+    visible = db.query(QuestionSet).filter(QuestionSet.status != EnumSetStatus.deleting)
     if user.role == EnumRole.admin:
-        return db.query(QuestionSet).all()
-    return user.maintain.all()
+        return visible.all()
+    return visible.join(set2user, set2user.c.set_id == QuestionSet.id) \
+        .filter(set2user.c.user_id == user.id).all()
 
 
 @router.post('/', response_model=QuestionSetCreated, status_code=status.HTTP_201_CREATED)
 def create_question_set(args: QuestionSetCreate, db: Session = Depends(get_db),
-                        user_id: int = Depends(get_logged_user)):
-    user = db.query(User).get(user_id)
+                        user: CurrentUser = Depends(get_current_user)):
     if not guardian.can_create_question_set(user):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission denied')
     qs = QuestionSet(name=args.name,
                      description=args.description,
                      permission=args.permission,
-                     created_by=user,
-                     owner=user,
-                     modified_by=user)
-    qs.maintainer.append(user)
+                     created_by_id=user.id,
+                     owner_id=user.id,
+                     modified_by_id=user.id)
 
     db.add(qs)
+    db.flush()
+    db.execute(insert(set2user).values(set_id=qs.id, user_id=user.id))
     db.commit()
+    guardian.invalidate_acl([user.id])
 
     collection_name = '_' + str(qs.id)
     milvus.create_collection(collection_name)  # 按理说这个名字的 collection 是不存在的
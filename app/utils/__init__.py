@@ -2,12 +2,32 @@ from prometheus_fastapi_instrumentator import Instrumentator
 from sqlalchemy.orm import Query
 from starlette.templating import Jinja2Templates
 
-from .milvus_util import MilvusUtil
+from .numpy_index import NumpyIndex, TieredIndex, load_from_db
 from .pagination import paginate
+from .vector_index import VectorIndex
+from .write_behind import WriteBehindIndex
+from ..config import settings
 
 Query.paginate = paginate
 
-milvus = MilvusUtil()
+
+def create_vector_index() -> VectorIndex:
+    if settings.vector_backend == 'numpy':
+        return NumpyIndex(loader=load_from_db)
+    from .milvus_util import MilvusUtil, MilvusPartitionUtil  # numpy 模式下不需要安装 pymilvus
+    if settings.milvus_layout == 'partition':
+        remote = MilvusPartitionUtil(settings.milvus_collection, auto_flush=not settings.milvus_write_behind)
+    else:
+        remote = MilvusUtil(auto_flush=not settings.milvus_write_behind)
+    if settings.milvus_write_behind:
+        remote = WriteBehindIndex(remote, settings.milvus_write_max_pending, settings.milvus_write_max_age)
+    if settings.vector_backend == 'auto':
+        return TieredIndex(remote, NumpyIndex(loader=load_from_db), settings.local_index_max_size)
+    return remote
+
+
+# 沿用 milvus 这个名字，实际可能是任一 VectorIndex 实现
+milvus = create_vector_index()
 
 templates = Jinja2Templates(directory='templates')
 
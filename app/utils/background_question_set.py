@@ -0,0 +1,152 @@
+from sqlalchemy import select, delete
+from starlette.concurrency import run_in_threadpool
+
+from app.config import settings
+from app.models.models import QuestionSet, EnumPermission, EnumSetStatus, set2question, set2user
+from app.utils import milvus, membership, query_cache, guardian, jobs
+from app.utils.database import SessionLocal
+
+# 问题库的公开、私有、删除都按问题 id 分块执行，每块一个事务，checkpoint 为已处理到的问题 id
+
+
+def _members(db, sid, after, exclude_public=False):
+    """问题库中 id 大于 after 的下一块问题；exclude_public 时去掉已在（或仍在）_1 中的"""
+    stmt = select(set2question.c.question_id) \
+        .where(set2question.c.set_id == sid, set2question.c.question_id > after) \
+        .order_by(set2question.c.question_id).limit(settings.import_chunk_size)
+    qids = db.execute(stmt).scalars().all()
+    if exclude_public and qids:
+        in_public = set(db.execute(select(set2question.c.question_id)
+                                   .where(set2question.c.set_id == 1,
+                                          set2question.c.question_id.in_(qids))).scalars())
+        return qids, [qid for qid in qids if qid not in in_public]
+    return qids, qids
+
+
+def _publish_chunk(sid, after):
+    # 尚未编码的问题跳过，编码任务保存时看到问题库正在公开会写入 _1；
+    # 已由编码任务写入的会在这里删后重写，不会重复
+    with SessionLocal() as db:
+        qids, new = _members(db, sid, after, exclude_public=True)
+        membership.push_vectors(db, ['_1'], new, replace=True)
+    return qids
+
+
+def _publish_switch(sid):
+    """所有向量写入后，在一个事务中设为公开并加入 _1"""
+    with SessionLocal() as db:
+        qs = db.query(QuestionSet).get(sid)
+        membership.publish(db, sid)
+        qs.permission = EnumPermission.public
+        qs.status = EnumSetStatus.normal
+        query_cache.invalidate(db, [sid], True)
+        db.commit()
+
+
+def _unpublish_switch(sid):
+    """先在一个事务中设为私有并移出 _1，之后再清理 milvus 中 _1 的向量"""
+    with SessionLocal() as db:
+        qs = db.query(QuestionSet).get(sid)
+        if qs.permission == EnumPermission.public:
+            membership.unpublish(db, sid)
+            qs.permission = EnumPermission.private
+            query_cache.invalidate(db, [sid], True)
+        db.commit()
+
+
+def _unpublish_chunk(sid, after):
+    with SessionLocal() as db:
+        qids, gone = _members(db, sid, after, exclude_public=True)
+    membership.drop_vectors(['_1'], gone)
+    return qids
+
+
+def _set_status(sid, status):
+    with SessionLocal() as db:
+        db.query(QuestionSet).filter(QuestionSet.id == sid).update({QuestionSet.status: status})
+        db.commit()
+
+
+def _delete_chunk(sid, public):
+    """删除下一块成员关系；已删除的不会再被取到，重试时自然从剩余的开始"""
+    with SessionLocal() as db:
+        qids, gone = _members(db, sid, 0, exclude_public=True)
+        if qids:
+            db.execute(delete(set2question).where(set2question.c.set_id == sid,
+                                                  set2question.c.question_id.in_(qids)))
+            db.commit()
+    if public and milvus.stores_public_copy:
+        membership.drop_vectors(['_1'], gone)
+    return qids
+
+
+def _delete_finish(sid):
+    milvus.drop_collection('_' + str(sid))
+    with SessionLocal() as db:
+        maintainers = db.execute(select(set2user.c.user_id).where(set2user.c.set_id == sid)).scalars().all()
+        db.execute(delete(set2question).where(set2question.c.set_id == sid))  # 期间新加入的
+        db.execute(delete(set2user).where(set2user.c.set_id == sid))
+        db.query(QuestionSet).filter(QuestionSet.id == sid).delete(synchronize_session=False)
+        db.commit()
+    guardian.invalidate_acl(maintainers)
+
+
+@jobs.on_failure('publish_question_set')
+def _publish_failed(payload):
+    """公开失败：保持私有，清理已写入 _1 的向量"""
+    sid = payload['sid']
+    if milvus.stores_public_copy:
+        after = 0
+        while True:
+            qids = _unpublish_chunk(sid, after)
+            if not qids:
+                break
+            after = qids[-1]
+    _set_status(sid, EnumSetStatus.normal)
+
+
+@jobs.on_failure('unpublish_question_set')
+@jobs.on_failure('delete_question_set')
+def _reset_status(payload):
+    """私有、删除失败：恢复为可操作的状态，可以再次提交；_1 中残留的向量不在成员关系中，不会被返回"""
+    _set_status(payload['sid'], EnumSetStatus.normal)
+
+
+async def _chunks(ctx: jobs.JobContext, fn, sid):
+    after = ctx.checkpoint or 0
+    while True:
+        qids = await run_in_threadpool(fn, sid, after)
+        if not qids:
+            return
+        after = qids[-1]
+        await ctx.advance(len(qids), checkpoint=after)
+
+
+@jobs.handler('publish_question_set')
+async def publish(ctx: jobs.JobContext, payload):
+    sid = payload['sid']
+    if milvus.stores_public_copy:  # partition 布局下只需改 permission
+        await _chunks(ctx, _publish_chunk, sid)
+        await run_in_threadpool(milvus.flush, ['_1'])
+    await run_in_threadpool(_publish_switch, sid)
+
+
+@jobs.handler('unpublish_question_set')
+async def unpublish(ctx: jobs.JobContext, payload):
+    sid = payload['sid']
+    await run_in_threadpool(_unpublish_switch, sid)
+    if milvus.stores_public_copy:
+        await _chunks(ctx, _unpublish_chunk, sid)
+    await run_in_threadpool(_set_status, sid, EnumSetStatus.normal)
+
+
+@jobs.handler('delete_question_set')
+async def remove(ctx: jobs.JobContext, payload):
+    sid, public = payload['sid'], payload['public']
+    await run_in_threadpool(_unpublish_switch, sid)
+    while True:
+        qids = await run_in_threadpool(_delete_chunk, sid, public)
+        if not qids:
+            break
+        await ctx.advance(len(qids))
+    await run_in_threadpool(_delete_finish, sid)
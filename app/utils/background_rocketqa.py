@@ -1,20 +1,118 @@
-import json
-from typing import List
+import asyncio
 
-from sqlalchemy.orm import Session
+from loguru import logger
+from starlette.concurrency import run_in_threadpool
 
+from app.config import settings
 from app.models.models import Question
-from app.utils import rocketqa, milvus
+from app.utils import embedding_store, membership, query_cache, vector, jobs
 from app.utils.database import SessionLocal
 
 
-async def create(titles, contents, questions: List[Question], sid, public):
-    emb_arrays = await rocketqa.async_get_paras(titles, contents)
+def _load(qids):
+    # 只取尚未编码的，任务重试时已完成的块直接跳过
     with SessionLocal() as db:
-        for question, emb_array in zip(questions, emb_arrays):
-            question.embedding = json.dumps(emb_array)
+        return db.query(Question.id, Question.title, Question.content) \
+            .filter(Question.id.in_(qids), Question.embedding == b'').order_by(Question.id).all()
+
+
+def _next_chunk(payload, after):
+    """导入任务只记录 id 范围与导入者，按 id 分块取出这次导入的问题"""
+    with SessionLocal() as db:
+        rows = db.query(Question.id) \
+            .filter(Question.id > after, Question.id >= payload['first_id'], Question.id <= payload['last_id'],
+                    Question.created_by_id == payload['user_id']) \
+            .order_by(Question.id).limit(settings.import_chunk_size).all()
+        return [row.id for row in rows]
+
+
+async def _chunks(payload):
+    if 'chunks' in payload:  # 旧版本提交的任务
+        for qids in payload['chunks']:
+            yield qids
+        return
+    if payload['first_id'] is None:
+        return
+    after = 0
+    while True:
+        qids = await run_in_threadpool(_next_chunk, payload, after)
+        if not qids:
+            return
+        yield qids
+        after = qids[-1]
+
+
+def _save(qids, emb_arrays):
+    """写入一块的向量：数据库一次批量更新，milvus 每个 collection 一次批量写入。
+
+    先锁住问题行，再在同一事务中读取成员关系；问题库成员变化时以 FOR SHARE 读取向量，
+    两边按问题串行：编码前加入的由这里写入，编码后加入的由成员变化一方写入。
+    不使用 write-behind 时 milvus 写入失败直接回滚；使用时写入先进缓冲区，
+    任务结束时的 flush 失败会让任务重试，重试时由 _repush 重新写入已保存向量的行。
+    """
+    index = {qid: i for i, qid in enumerate(qids)}
+    with SessionLocal() as db:
+        # 同一用户同时导入时两个任务的 id 范围可能交错，锁住后只保存仍未编码的行
+        rows = db.query(Question.id).filter(Question.id.in_(qids), Question.embedding == b'') \
+            .order_by(Question.id).with_for_update().all()
+        qids = [row.id for row in rows]
+        if not qids:
+            return 0
+        db.bulk_update_mappings(Question, [{'id': qid, 'embedding': vector.to_bytes(emb_arrays[index[qid]])}
+                                           for qid in qids])
+        sids = membership.write_vectors(db, qids, emb_arrays[[index[qid] for qid in qids]])
+        query_cache.invalidate(db, sids)
         db.commit()
-    qids = [question.id for question in questions]
-    milvus.insert('_' + str(sid), emb_arrays, qids)
-    if public:
-        milvus.insert('_1', emb_arrays, qids)
+    return len(qids)
+
+
+def _repush(qids):
+    """重新写入这一块中已保存向量的行：上一次执行的 milvus 写入可能没有落地（flush 失败、进程退出）。
+
+    先删后插，已经落地的不会重复。
+    """
+    with SessionLocal() as db:
+        rows = db.query(Question.id, Question.embedding) \
+            .filter(Question.id.in_(qids), Question.embedding != b'') \
+            .order_by(Question.id).with_for_update(read=True).all()
+        if not rows:
+            return
+        embeddings = vector.stack([row.embedding for row in rows])
+        sids = membership.write_vectors(db, [row.id for row in rows], embeddings, replace=True)
+        query_cache.invalidate(db, sids)
+        db.commit()
+
+
+@jobs.handler('encode_questions')
+async def create(ctx: jobs.JobContext, payload):
+    """按块编码导入的问题，最多 import_encode_concurrency 块同时编码，每块完成后立即落库"""
+    semaphore = asyncio.Semaphore(settings.import_encode_concurrency)
+
+    async def encode(qids):
+        try:
+            if ctx.attempt > 1:
+                await run_in_threadpool(_repush, qids)
+            rows = await run_in_threadpool(_load, qids)
+            if rows:
+                # 内容相同的问题（如重复导入同一文件）直接复用已有向量
+                emb_arrays = await embedding_store.async_get_paras([row.title for row in rows],
+                                                                   [row.content for row in rows])
+                saved = await run_in_threadpool(_save, [row.id for row in rows], emb_arrays)
+                # 重试时之前已编码的行不再计入进度
+                await ctx.advance(saved)
+        finally:
+            semaphore.release()
+
+    # 取下一块之前先等待空位，同时在内存中的最多 import_encode_concurrency 块
+    tasks = []
+    try:
+        async for qids in _chunks(payload):
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(encode(qids)))
+    finally:
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    for error in errors:
+        logger.error('Encode questions error: {}', error)
+    if errors:
+        raise errors[0]
@@ -0,0 +1,54 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import cache_hits, cache_misses, cache_evictions
+
+
+class TTLCache:
+    """带过期时间的 LRU 缓存，线程安全（同步路由跑在线程池里）"""
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        if self.maxsize <= 0:
+            return default
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expire, value = item
+                if expire > now:
+                    self._data.move_to_end(key)
+                    cache_hits.labels(self.name).inc()
+                    return value
+                del self._data[key]
+                cache_evictions.labels(self.name).inc()
+        cache_misses.labels(self.name).inc()
+        return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                cache_evictions.labels(self.name).inc()
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
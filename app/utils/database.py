@@ -1,10 +1,27 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from .sql_metrics import instrument_engine, TimedQueuePool, TimedAsyncAdaptedQueuePool
 from ..config import settings
 
-engine = create_engine(settings.database_uri)
+engine = create_engine(settings.database_uri, poolclass=TimedQueuePool)
+instrument_engine(engine, 'sync')
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def _async_uri():
+    if settings.async_database_uri:
+        return settings.async_database_uri
+    return make_url(settings.database_uri).set(drivername='postgresql+asyncpg')
+
+
+# 读多的接口使用异步引擎，并发受连接池而不是线程池限制
+async_engine = create_async_engine(_async_uri(), pool_size=settings.async_pool_size,
+                                   max_overflow=settings.async_max_overflow, poolclass=TimedAsyncAdaptedQueuePool)
+instrument_engine(async_engine.sync_engine, 'async')
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
@@ -0,0 +1,74 @@
+import hashlib
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import rocketqa, vector
+from .database import SessionLocal
+from .metrics import cache_hits, cache_misses
+from ..config import settings
+from ..models.models import EmbeddingStore
+
+
+def content_key(title, content) -> bytes:
+    h = hashlib.sha256()
+    for part in (settings.rocketqa_model, title, content):
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.digest()
+
+
+def lookup(db: Session, keys):
+    rows = db.query(EmbeddingStore.key, EmbeddingStore.embedding).filter(EmbeddingStore.key.in_(set(keys))).all()
+    found = {row.key: row.embedding for row in rows}
+    hits = sum(1 for key in keys if key in found)
+    cache_hits.labels('embedding_store').inc(hits)
+    cache_misses.labels('embedding_store').inc(len(keys) - hits)
+    return found
+
+
+def store(db: Session, found):
+    """found: key -> 向量二进制；并发写入同一内容时忽略冲突，由调用者 commit"""
+    if found:
+        db.execute(insert(EmbeddingStore).values([{'key': key, 'embedding': embedding}
+                                                  for key, embedding in found.items()])
+                   .on_conflict_do_nothing())
+
+
+def _lookup(keys):
+    with SessionLocal() as db:
+        return lookup(db, keys)
+
+
+def _store(found):
+    with SessionLocal() as db:
+        store(db, found)
+        db.commit()
+
+
+def get_para(db: Session, title, content) -> bytes:
+    """同步版本，返回向量二进制；未命中时请求 RocketQA 并写入 db（由调用者 commit）"""
+    key = content_key(title, content)
+    found = lookup(db, [key])
+    if key not in found:
+        found[key] = vector.to_bytes(rocketqa.get_para(title, content))
+        store(db, {key: found[key]})
+    return found[key]
+
+
+async def async_get_paras(titles, contents):
+    """返回 (n, DIM) 矩阵；只把未命中的标题与内容发给 RocketQA，结果立即写入 embedding_store"""
+    keys = [content_key(title, content) for title, content in zip(titles, contents)]
+    found = await run_in_threadpool(_lookup, keys)
+    misses = {}
+    for i, key in enumerate(keys):
+        if key not in found:
+            misses.setdefault(key, i)
+    if misses:
+        indexes = list(misses.values())
+        emb_arrays = await rocketqa.async_get_paras([titles[i] for i in indexes], [contents[i] for i in indexes])
+        encoded = {key: vector.to_bytes(emb_array) for key, emb_array in zip(misses, emb_arrays)}
+        await run_in_threadpool(_store, encoded)
+        found.update(encoded)
+    return vector.stack([found[key] for key in keys])
@@ -1,40 +1,98 @@
-from ..models.models import User, QuestionSet, Question, EnumRole, EnumPermission
+from typing import FrozenSet, Iterable, Optional, Set
 
+from sqlalchemy import select, or_, exists
+from sqlalchemy.orm import Session
 
-def can_create_question(user: User):
-    if not user:
-        return False
-    if user.role == EnumRole.admin:
+from .cache import TTLCache
+from .users import CurrentUser
+from ..config import settings
+from ..models.models import QuestionSet, Question, EnumRole, EnumPermission, set2user, set2question
+
+# 用户维护的问题库 id；每个进程各有一份，只在本进程内主动失效。
+# 只用来快速放行：缓存中没有的问题库再查一次 set2user，其他进程新建的问题库不会被误拒；
+# 撤销维护者后其他进程最多晚 acl_cache_ttl 秒看到
+acl_cache = TTLCache('acl', settings.acl_cache_size, settings.acl_cache_ttl)
+
+
+def maintained_sets(db: Session, user: CurrentUser) -> FrozenSet[int]:
+    maintain = acl_cache.get(user.id)
+    if maintain is None:
+        maintain = frozenset(db.execute(select(set2user.c.set_id).where(set2user.c.user_id == user.id)).scalars())
+        acl_cache.set(user.id, maintain)
+    return maintain
+
+
+def _maintains(db: Session, user: CurrentUser, sid: int) -> bool:
+    if sid in maintained_sets(db, user):
         return True
-    return True
+    if db.execute(select(exists().where(set2user.c.user_id == user.id, set2user.c.set_id == sid))).scalar():
+        acl_cache.pop(user.id)  # 缓存已过时，下次重新读取
+        return True
+    return False
+
+
+def invalidate_acl(user_ids: Iterable[int]):
+    """维护者、所有者变化后调用；问题库的 permission 每次都从数据库读取，不需要失效"""
+    for user_id in user_ids:
+        acl_cache.pop(user_id)
+
+
+def _question_clause(user_id: int, modify: bool):
+    """可读/可改的问题：自己创建的，或属于（除 _1 外）自己维护的问题库；读还包括公开问题库中的"""
+    # 维护关系直接在同一条语句里查，不经过缓存
+    in_set = set2question.c.set_id.in_(select(set2user.c.set_id).where(set2user.c.user_id == user_id))
+    if not modify:
+        in_set = or_(in_set, QuestionSet.permission == EnumPermission.public)
+    belongs = exists(select(set2question.c.question_id)
+                     .join(QuestionSet, QuestionSet.id == set2question.c.set_id)
+                     .where(set2question.c.question_id == Question.id, set2question.c.set_id != 1, in_set))
+    return or_(Question.created_by_id == user_id, belongs)
 
 
-def can_get_question(user: User, question: Question):
+def _filter_questions(db: Session, user: Optional[CurrentUser], qids: Iterable[int], modify: bool) -> Set[int]:
+    qids = set(qids)
+    if not user or not qids:
+        return set()
     if user.role == EnumRole.admin:
-        return True
-    return question.created_by == user or can_get_question_set(user,
-                                                               question.belongs.filter(QuestionSet.id != 1).first())
+        return qids
+    clause = _question_clause(user.id, modify)
+    return set(db.execute(select(Question.id).where(Question.id.in_(qids), clause)).scalars())
+
 
+def readable_questions(db: Session, user: Optional[CurrentUser], qids: Iterable[int]) -> Set[int]:
+    """批量检查，返回其中用户可读的问题 id"""
+    return _filter_questions(db, user, qids, modify=False)
 
-def can_modify_question(user: User, question: Question):
+
+def _can_question(db: Session, user: Optional[CurrentUser], question: Question, modify: bool):
     if not user:
         return False
-    if user.role == EnumRole.admin:
+    if user.role == EnumRole.admin or question.created_by_id == user.id:
         return True
-    return question.created_by == user or can_modify_question_set(user,
-                                                                  question.belongs.filter(QuestionSet.id != 1).first())
+    return bool(_filter_questions(db, user, [question.id], modify))
 
 
-def can_delete_question(user: User, question: Question):
+def can_create_question(user: Optional[CurrentUser]):
     if not user:
         return False
     if user.role == EnumRole.admin:
         return True
-    return question.created_by == user or can_modify_question_set(user,
-                                                                  question.belongs.filter(QuestionSet.id != 1).first())
+    return True
+
+
+def can_get_question(db: Session, user: Optional[CurrentUser], question: Question):
+    return _can_question(db, user, question, modify=False)
+
+
+def can_modify_question(db: Session, user: Optional[CurrentUser], question: Question):
+    return _can_question(db, user, question, modify=True)
 
 
-def can_create_question_set(user: User):
+def can_delete_question(db: Session, user: Optional[CurrentUser], question: Question):
+    return _can_question(db, user, question, modify=True)
+
+
+def can_create_question_set(user: Optional[CurrentUser]):
     if not user:
         return False
     if user.role == EnumRole.admin:
@@ -42,37 +100,25 @@ def can_create_question_set(user: User):
     return True
 
 
-def can_get_question_set(user: User, question_set: QuestionSet):  # 和 can_query 是否要区分开？
+def can_get_question_set(db: Session, user: Optional[CurrentUser], question_set: QuestionSet):  # 和 can_query 是否要区分开？
     if question_set.permission == EnumPermission.public:
         return True
     if not user:
         return False
     if user.role == EnumRole.admin:
         return True
-    if user in question_set.maintainer:
-        return True
-    return False
+    return _maintains(db, user, question_set.id)
 
 
-def can_modify_question_set(user: User, question_set: QuestionSet):
+def can_modify_question_set(db: Session, user: Optional[CurrentUser], question_set: QuestionSet):
     if not user:
         return False
     if question_set.id == 1:
         return False
     if user.role == EnumRole.admin:
         return True
-    if user in question_set.maintainer:
-        return True
-    return False
+    return _maintains(db, user, question_set.id)
 
 
-def can_delete_question_set(user: User, question_set: QuestionSet):
-    if not user:
-        return False
-    if question_set.id == 1:
-        return False
-    if user.role == EnumRole.admin:
-        return True
-    if user in question_set.maintainer:
-        return True
-    return False
+def can_delete_question_set(db: Session, user: Optional[CurrentUser], question_set: QuestionSet):
+    return can_modify_question_set(db, user, question_set)
@@ -0,0 +1,133 @@
+import math
+import threading
+import time
+
+from loguru import logger
+from milvus import IndexType
+
+from ..config import settings
+
+_SEARCH_PARAMS = {
+    IndexType.IVF_FLAT: lambda top_k: {'nprobe': settings.index_nprobe},
+    IndexType.IVF_SQ8: lambda top_k: {'nprobe': settings.index_nprobe},
+    IndexType.HNSW: lambda top_k: {'ef': max(settings.index_ef, top_k)},
+}
+
+
+def choose_index(count):
+    """按数据量选择索引，返回 (IndexType, 建索引参数)；数据量小时直接暴力检索"""
+    nlist = min(max(int(4 * math.sqrt(max(count, 1))), 64), 16384)
+    if settings.index_sq8_threshold and count >= settings.index_sq8_threshold:
+        return IndexType.IVF_SQ8, {'nlist': nlist}
+    if settings.index_hnsw_threshold and count >= settings.index_hnsw_threshold:
+        return IndexType.HNSW, {'M': settings.index_hnsw_m, 'efConstruction': settings.index_hnsw_ef_construction}
+    if settings.index_ivf_threshold and count >= settings.index_ivf_threshold:
+        return IndexType.IVF_FLAT, {'nlist': nlist}
+    return IndexType.FLAT, {}
+
+
+class _State:
+    def __init__(self, index_type, params, built_count, checked_at, count):
+        self.index_type = index_type
+        self.params = params
+        self.built_count = built_count
+        self.checked_at = checked_at
+        self.count = count  # checked_at 时的数据量
+
+
+class IndexManager:
+    """管理 milvus collection 的索引：数据量越过阈值或比上次建索引时增长 index_rebuild_ratio 倍后，
+    在后台线程中重建索引；并给出与索引类型对应的检索参数（nprobe / ef）。"""
+
+    def __init__(self, client):
+        self.client = client
+        self._states = {}
+        self._building = set()
+        self._lock = threading.Lock()
+
+    def _load_state(self, collection):
+        state = self._states.get(collection)
+        if state is not None and time.monotonic() - state.checked_at < settings.index_check_interval:
+            return state
+        status, index = self.client.get_index_info(collection)
+        status_count, count = self.client.count_entities(collection)
+        index_type = IndexType(index.index_type) if status.OK() else IndexType.FLAT
+        params = index.params if status.OK() else {}
+        built_count = state.built_count if state is not None else count
+        state = _State(index_type, params, built_count, time.monotonic(), count)
+        self._states[collection] = state
+        return state
+
+    def search_params(self, collection, top_k):
+        try:
+            state = self._load_state(collection)
+        except Exception as e:
+            logger.error('Milvus get index info error: {}', e)
+            return None
+        params = _SEARCH_PARAMS.get(state.index_type)
+        return params(top_k) if params else None
+
+    def status(self, collection):
+        self._states.pop(collection, None)
+        state = self._load_state(collection)
+        status, count = self.client.count_entities(collection)
+        desired_type, desired_params = choose_index(count)
+        return {
+            'collection': collection,
+            'count': count,
+            'index_type': state.index_type.name,
+            'index_params': state.params,
+            'desired_index_type': desired_type.name,
+            'desired_index_params': desired_params,
+            'search_params': self.search_params(collection, 5),
+            'building': collection in self._building,
+        }
+
+    def plan(self, collection, force=False):
+        """需要（重）建索引时返回 (IndexType, params, count)，否则返回 None。
+
+        每次 flush 都会调用，数据量用 _State 中最多 index_check_interval 秒前的值，不逐次请求 count_entities；
+        force 时读取当前数据量。
+        """
+        state = self._load_state(collection)
+        count = self.client.count_entities(collection)[1] if force else state.count
+        index_type, params = choose_index(count)
+        if force:
+            if index_type == IndexType.FLAT:
+                index_type, params = IndexType.IVF_FLAT, choose_index(settings.index_ivf_threshold)[1]
+            return index_type, params, count
+        if index_type == IndexType.FLAT:
+            return None
+        if index_type == state.index_type and count < state.built_count * settings.index_rebuild_ratio:
+            return None
+        return index_type, params, count
+
+    def maybe_build(self, collection):
+        """写入 flush 后调用；需要时在后台线程建索引，不阻塞调用者"""
+        try:
+            plan = self.plan(collection)
+        except Exception as e:
+            logger.error('Milvus index check error: {}', e)
+            return
+        if plan is None:
+            return
+        with self._lock:
+            if collection in self._building:
+                return
+            self._building.add(collection)
+        threading.Thread(target=self.build, args=(collection, *plan),
+                         name=f'milvus-index-{collection}', daemon=True).start()
+
+    def build(self, collection, index_type, params, count):
+        try:
+            start = time.time()
+            logger.info('Building {} index on {} ({} entities)', index_type.name, collection, count)
+            status = self.client.create_index(collection, index_type, params)
+            logger.info('Index on {} built in {}s: {}', collection, time.time() - start, status)
+            self._states[collection] = _State(index_type, params, count, time.monotonic(), count)
+            return status
+        except Exception as e:
+            logger.error('Milvus create index error: {}', e)
+        finally:
+            with self._lock:
+                self._building.discard(collection)
@@ -0,0 +1,193 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+from loguru import logger
+from sqlalchemy import or_, and_
+from starlette.concurrency import run_in_threadpool
+
+from . import milvus
+from .database import SessionLocal
+from ..config import settings
+from ..models.models import Job, EnumJobStatus
+
+Handler = Callable[['JobContext', dict], Awaitable[None]]
+
+handlers: Dict[str, Handler] = {}
+failure_handlers: Dict[str, Callable[[dict], None]] = {}
+
+
+def handler(kind):
+    """注册某类任务的处理函数：async def fn(ctx: JobContext, payload: dict)"""
+
+    def decorator(fn):
+        handlers[kind] = fn
+        return fn
+
+    return decorator
+
+
+def on_failure(kind):
+    """注册任务重试用尽、最终失败时的清理函数（同步执行）：def fn(payload: dict)"""
+
+    def decorator(fn):
+        failure_handlers[kind] = fn
+        return fn
+
+    return decorator
+
+
+class JobContext:
+    def __init__(self, job_id, checkpoint=None, attempt=1):
+        self.job_id = job_id
+        self.checkpoint = checkpoint  # 上次执行（被中断前）保存的位置
+        self.attempt = attempt  # 第几次执行，大于 1 时之前的执行可能只完成了一部分
+
+    def _advance(self, n, checkpoint=None):
+        values = {
+            Job.progress: Job.progress + n,
+            Job.locked_until: datetime.now() + timedelta(seconds=settings.job_lease),
+        }
+        if checkpoint is not None:
+            values[Job.checkpoint] = checkpoint
+        with SessionLocal() as db:
+            db.query(Job).filter(Job.id == self.job_id).update(values, synchronize_session=False)
+            db.commit()
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+
+    async def advance(self, n, checkpoint=None):
+        """记录进度并续租；给出 checkpoint 时一并保存，重试时从这里继续"""
+        await run_in_threadpool(self._advance, n, checkpoint)
+
+
+def enqueue(db, kind, payload, total=0, user_id=None, hold=False) -> Job:
+    """新建任务，由调用者 commit。
+
+    hold 为 True 时任务内容还会变化，在 release 之前不会被认领；
+    提交者中途退出时，最后一次 hold 的 job_lease 秒后照常执行。
+    """
+    job = Job(kind=kind, payload=payload, total=total, created_by_id=user_id)
+    if hold:
+        job.run_at = datetime.now() + timedelta(seconds=settings.job_lease)
+    db.add(job)
+    db.flush()
+    return job
+
+
+def hold(db, job_id, payload, total):
+    """更新尚未 release 的任务内容并推迟执行，由调用者 commit"""
+    db.query(Job).filter(Job.id == job_id).update({
+        Job.payload: payload,
+        Job.total: total,
+        Job.run_at: datetime.now() + timedelta(seconds=settings.job_lease),
+    }, synchronize_session=False)
+
+
+def release(db, job_id):
+    """允许认领 hold 的任务，由调用者 commit"""
+    db.query(Job).filter(Job.id == job_id).update({Job.run_at: datetime.now()}, synchronize_session=False)
+
+
+def claim(job_id: Optional[int] = None):
+    """用 SELECT ... FOR UPDATE SKIP LOCKED 认领一个可执行的任务，返回 (id, kind, payload, checkpoint, attempts)"""
+    now = datetime.now()
+    with SessionLocal() as db:
+        query = db.query(Job).filter(
+            or_(Job.status == EnumJobStatus.pending,
+                and_(Job.status == EnumJobStatus.running, Job.locked_until < now)),
+            Job.run_at <= now)
+        if job_id is not None:
+            query = query.filter(Job.id == job_id)
+        job = query.order_by(Job.id).with_for_update(skip_locked=True).first()
+        if job is None:
+            return None
+        job.status = EnumJobStatus.running
+        job.attempts += 1
+        job.locked_until = now + timedelta(seconds=settings.job_lease)
+        db.commit()
+        return job.id, job.kind, job.payload, job.checkpoint, job.attempts
+
+
+def _finish(job_id, error=None):
+    """返回任务是否最终失败"""
+    with SessionLocal() as db:
+        job = db.query(Job).get(job_id)
+        job.locked_until = None
+        if error is None:
+            job.status = EnumJobStatus.done
+            job.progress = job.total  # 执行前已被其他途径完成的部分不会 advance
+            job.error = None
+        elif job.attempts < settings.job_max_attempts:
+            # 指数退避后重试
+            job.status = EnumJobStatus.pending
+            job.run_at = datetime.now() + timedelta(seconds=settings.job_retry_backoff * 2 ** (job.attempts - 1))
+            job.error = error[:3000]
+        else:
+            job.status = EnumJobStatus.failed
+            job.error = error[:3000]
+        db.commit()
+        return job.status == EnumJobStatus.failed
+
+
+async def run(claimed):
+    job_id, kind, payload, checkpoint, attempts = claimed
+    start = time.time()
+    try:
+        await handlers[kind](JobContext(job_id, checkpoint, attempts), payload)
+        # 写入真正可见后才标记完成；flush 失败时抛出 VectorIndexError，任务按退避重试
+        await run_in_threadpool(milvus.flush)
+    except Exception as e:
+        logger.exception('Job {} ({}) failed', job_id, kind)
+        failed = await run_in_threadpool(_finish, job_id, repr(e))
+        if failed and kind in failure_handlers:
+            try:
+                await run_in_threadpool(failure_handlers[kind], payload)
+            except Exception:
+                logger.exception('Job {} ({}) failure handler error', job_id, kind)
+        return
+    await run_in_threadpool(_finish, job_id)
+    logger.info('Job {} ({}) done in {}s', job_id, kind, time.time() - start)
+
+
+async def run_inline(job_id):
+    """没有独立 worker 时，在 web 进程的 BackgroundTasks 中执行刚提交的任务"""
+    claimed = await run_in_threadpool(claim, job_id)
+    if claimed is not None:
+        await run(claimed)
+
+
+async def work(poll_interval):
+    """worker 主循环，一次执行一个任务；租约过期的 running 任务（执行者已退出）也会被重新认领"""
+    while True:
+        try:
+            claimed = await run_in_threadpool(claim)
+        except Exception:
+            logger.exception('Cannot claim job')
+            claimed = None
+        if claimed is None:
+            await asyncio.sleep(poll_interval)
+            continue
+        await run(claimed)
+
+
+_poller: Optional[asyncio.Task] = None
+
+
+def start_polling(poll_interval):
+    """没有独立 worker 时，每个 web 进程也轮询 job 表，重试失败的任务并接手中断的任务"""
+    global _poller
+    _poller = asyncio.create_task(work(poll_interval))
+
+
+async def stop_polling():
+    global _poller
+    if _poller is not None:
+        # 执行到一半的任务在租约过期后由其他进程接手
+        _poller.cancel()
+        try:
+            await _poller
+        except asyncio.CancelledError:
+            pass
+        _poller = None
@@ -0,0 +1,74 @@
+import re
+import unicodedata
+from math import ceil
+
+from sqlalchemy import select, func, delete, insert
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models.models import question_gram, set2question
+
+TITLE_WEIGHT = 3
+CONTENT_WEIGHT = 1
+MAX_WORD = 32
+
+_CJK = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+_TOKEN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[0-9a-z]+')
+
+
+def grams(text, unigrams=False):
+    """中文按连续汉字切成二元组（unigrams 时另加单字），英文/数字按单词，大小写与全半角归一"""
+    output = set()
+    text = unicodedata.normalize('NFKC', text).lower()
+    for run in _TOKEN.findall(text):
+        if _CJK.fullmatch(run):
+            if unigrams or len(run) == 1:
+                output.update(run)
+            output.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            output.add(run[:MAX_WORD])
+    return output
+
+
+def question_grams(title, content):
+    weights = {}
+    for gram in grams(content):
+        weights[gram] = CONTENT_WEIGHT
+    # 标题加入单字，一个字的查询只匹配标题
+    for gram in grams(title, unigrams=True):
+        weights[gram] = weights.get(gram, 0) + TITLE_WEIGHT
+    return weights
+
+
+def index_questions(db: Session, questions, replace=True):
+    """questions: (id, title, content) 序列；replace 时先删除旧的索引（修改问题），由调用者 commit"""
+    questions = list(questions)
+    if not questions:
+        return
+    if replace:
+        db.execute(delete(question_gram).where(question_gram.c.question_id.in_([q[0] for q in questions])))
+    rows = [{'gram': gram, 'question_id': qid, 'weight': weight}
+            for qid, title, content in questions
+            for gram, weight in question_grams(title, content).items()]
+    for i in range(0, len(rows), 5000):
+        db.execute(insert(question_gram), rows[i:i + 5000])
+
+
+def ranked(set_id, text):
+    """问题库内匹配 text 的问题的子查询 (question_id, matched, score)，没有可检索的词时返回 None。
+
+    只沿 gram 的倒排表与 set2question 的主键查找，耗时与命中的倒排表长度有关而与问题库大小无关。
+    按命中词数、再按权重和排序；至少命中 keyword_min_match 比例的查询词。
+    """
+    query_grams = grams(text)
+    if not query_grams:
+        return None
+    matched = func.count().label('matched')
+    score = func.sum(question_gram.c.weight).label('score')
+    return select(question_gram.c.question_id, matched, score) \
+        .join(set2question, (set2question.c.question_id == question_gram.c.question_id)
+              & (set2question.c.set_id == set_id)) \
+        .where(question_gram.c.gram.in_(query_grams)) \
+        .group_by(question_gram.c.question_id) \
+        .having(func.count() >= ceil(len(query_grams) * settings.keyword_min_match)) \
+        .subquery()
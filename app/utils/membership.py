@@ -0,0 +1,124 @@
+from collections import defaultdict
+from itertools import islice
+
+from sqlalchemy import select, delete, literal, exists
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from . import milvus, vector
+from ..models.models import Question, QuestionSet, EnumPermission, EnumSetStatus, set2question
+
+# 读取向量并写入 milvus 时每批的问题数，约 3 KB/个
+VECTOR_BATCH = 5000
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _in_other_public_set(sid):
+    """问题还属于 sid 之外的公开问题库，不能从 _1 中移除"""
+    other = set2question.alias('other')
+    return exists(select(other.c.question_id)
+                  .join(QuestionSet, QuestionSet.id == other.c.set_id)
+                  .where(other.c.question_id == set2question.c.question_id,
+                         QuestionSet.permission == EnumPermission.public,
+                         QuestionSet.id != 1, QuestionSet.id != sid))
+
+
+def add(db: Session, sid, qids):
+    """把已存在的问题加入问题库，已在库中的忽略；返回新加入的问题 id"""
+    stmt = insert(set2question).from_select(
+        ['set_id', 'question_id'], select(literal(sid), Question.id).where(Question.id.in_(qids)))
+    return db.execute(stmt.on_conflict_do_nothing().returning(set2question.c.question_id)).scalars().all()
+
+
+def remove(db: Session, sid, qids):
+    """从问题库移除，不在库中的忽略；返回实际移除的问题 id"""
+    stmt = delete(set2question).where(set2question.c.set_id == sid, set2question.c.question_id.in_(qids))
+    return db.execute(stmt.returning(set2question.c.question_id)).scalars().all()
+
+
+def publish(db: Session, sid, qids=None):
+    """把问题库（或其中的 qids）加入 _1；返回新加入 _1 的问题 id"""
+    members = select(literal(1), set2question.c.question_id).where(set2question.c.set_id == sid)
+    if qids is not None:
+        members = members.where(set2question.c.question_id.in_(qids))
+    stmt = insert(set2question).from_select(['set_id', 'question_id'], members)
+    return db.execute(stmt.on_conflict_do_nothing().returning(set2question.c.question_id)).scalars().all()
+
+
+def unpublish(db: Session, sid, qids=None):
+    """从 _1 中移除问题库（或 qids）的问题，仍属于其他公开问题库的保留；返回从 _1 移除的问题 id"""
+    if qids is None:
+        qids = select(set2question.c.question_id).where(set2question.c.set_id == sid)
+    stmt = delete(set2question).where(set2question.c.set_id == 1, set2question.c.question_id.in_(qids),
+                                      ~_in_other_public_set(sid))
+    return db.execute(stmt.returning(set2question.c.question_id)).scalars().all()
+
+
+def push_vectors(db: Session, names, qids, replace=False):
+    """分批读取已编码问题的向量，批量写入 names 中的每个 collection；replace 时先删除，可重复写入。
+
+    在调用者的事务中以 FOR SHARE 读取，与编码任务保存向量（先 UPDATE 再读成员关系）按问题串行；
+    尚未编码的，编码任务保存时会按那时的成员关系写入，需在 commit 之前调用。
+    """
+    for chunk in _chunked(sorted(qids), VECTOR_BATCH):
+        rows = db.query(Question.id, Question.embedding) \
+            .filter(Question.id.in_(chunk), Question.embedding != b'') \
+            .order_by(Question.id).with_for_update(read=True).all()
+        if not rows:
+            continue
+        embeddings = vector.stack([row.embedding for row in rows])
+        ids = [row.id for row in rows]
+        for name in names:
+            if replace:
+                milvus.delete(name, ids)
+            milvus.insert(name, embeddings, ids)
+
+
+def targets(db: Session, qids):
+    """按当前的成员关系与问题库状态，返回 (sid 集合, collection -> 问题 id 列表, 是否因公开中的问题库写 _1)。
+
+    正在公开的问题库视为公开：分块写入 _1 的后台任务可能已经处理过这些问题；正在删除的问题库不再写入。
+    """
+    rows = db.query(set2question.c.question_id, QuestionSet.id, QuestionSet.status) \
+        .join(QuestionSet, QuestionSet.id == set2question.c.set_id) \
+        .filter(set2question.c.question_id.in_(qids), QuestionSet.status != EnumSetStatus.deleting).all()
+    sids, names, publishing = set(), defaultdict(set), False
+    for qid, sid, set_status in rows:
+        sids.add(sid)
+        if sid != 1 or milvus.stores_public_copy:
+            names['_' + str(sid)].add(qid)
+        if set_status == EnumSetStatus.publishing and milvus.stores_public_copy:
+            names['_1'].add(qid)
+            publishing = True
+    return sids, {name: sorted(ids) for name, ids in names.items()}, publishing
+
+
+def write_vectors(db: Session, qids, embeddings, replace=False):
+    """把 qids（与 embeddings 按行对应）写入它们当前所属的每个 collection，返回涉及的 sid，由调用者 commit。
+
+    调用者需已锁住这些问题行（或刚插入）；replace 时先删除，用于更新向量或重新写入。
+    """
+    index = {qid: i for i, qid in enumerate(qids)}
+    sids, names, publishing = targets(db, qids)
+    for name, ids in names.items():
+        if replace:
+            milvus.delete(name, ids)
+        milvus.insert(name, embeddings[[index[qid] for qid in ids]], ids)
+    if publishing:
+        # 公开任务所在的进程在 commit 之后才能读到向量，先让 _1 的写入落地，它的删后重写才不会留下重复
+        milvus.flush(['_1'])
+    return sids
+
+
+def drop_vectors(names, qids):
+    for chunk in _chunked(qids, VECTOR_BATCH):
+        for name in names:
+            milvus.delete(name, chunk)
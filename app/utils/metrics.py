@@ -0,0 +1,30 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# 由 instrumentator 暴露在 /metrics
+
+cache_hits = Counter('qa_cache_hits_total', 'Cache hits', ['cache'])
+cache_misses = Counter('qa_cache_misses_total', 'Cache misses', ['cache'])
+cache_evictions = Counter('qa_cache_evictions_total', 'Cache evictions (LRU or TTL)', ['cache'])
+
+rocketqa_batch_size = Histogram('qa_rocketqa_batch_size', 'Queries per coalesced step-1 request',
+                                buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+rocketqa_batch_queue_wait = Histogram('qa_rocketqa_batch_queue_wait_seconds',
+                                      'Time a query waited in the coalescing queue',
+                                      buckets=(.001, .0025, .005, .01, .025, .05, .1, .25))
+rocketqa_batch_window = Gauge('qa_rocketqa_batch_window_seconds', 'Configured coalescing window',
+                              multiprocess_mode='max')
+
+vector_write_buffer_depth = Gauge('qa_vector_write_buffer_depth', 'Buffered vector inserts and deletes',
+                                  ['collection'], multiprocess_mode='livesum')
+vector_write_flush_seconds = Histogram('qa_vector_write_flush_seconds', 'Write-behind flush latency', ['reason'])
+
+sql_statements = Histogram('qa_sql_statements_per_request', 'SQL statements issued per request', ['route'],
+                           buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100, 200))
+sql_seconds = Histogram('qa_sql_seconds_per_request', 'Total SQL time per request', ['route'])
+db_pool_wait = Histogram('qa_db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection',
+                         ['engine'], buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 30))
+db_pool_in_use = Gauge('qa_db_pool_in_use', 'Checked out connections', ['engine'], multiprocess_mode='livesum')
+db_pool_saturation = Gauge('qa_db_pool_saturation', 'Checked out connections / pool capacity', ['engine'],
+                           multiprocess_mode='max')
+
+query_degraded = Counter('qa_query_degraded_total', 'Hybrid queries answered from keyword results only', ['reason'])
@@ -1,13 +1,36 @@
+import numpy as np
 from loguru import logger
-from milvus import Milvus, IndexType, MetricType
+from milvus import Milvus, MetricType
+from sqlalchemy import text
 
+from . import vector
+from .database import engine
+from .index_manager import IndexManager
+from .vector_index import VectorIndex, VectorIndexError, Hit
 from ..config import settings
 
 
+def _check(status, action):
+    """写入类操作失败时抛出，不能只记日志：调用者（如 write-behind 缓冲、后台任务）需要据此重试"""
+    if not status.OK():
+        raise VectorIndexError(f'Milvus {action} error: {status}')
+
+
 # 暂时用Milvus, 还没测PgVector（postgresql的插件）
-class MilvusUtil:
-    def __init__(self):
+class MilvusUtil(VectorIndex):
+    def __init__(self, auto_flush=True):
         self.client = Milvus(host=settings.milvus_host, port=settings.milvus_port)
+        # 由 WriteBehindIndex 统一 flush 时关闭
+        self.auto_flush = auto_flush
+        self.indexes = IndexManager(self.client)
+
+    def _target(self, name):
+        """返回写入的 (collection, partition_tag)"""
+        return name, None
+
+    def _search_target(self, name, version=None):
+        """返回检索的 (collection, partition_tags)"""
+        return name, None
 
     def has_collection(self, name):
         try:
@@ -20,7 +43,7 @@ class MilvusUtil:
         try:
             param = {
                 'collection_name': name,
-                'dimension': 768,
+                'dimension': vector.DIM,
                 'index_file_size': 256,
                 'metric_type': MetricType.L2
             }
@@ -30,6 +53,14 @@ class MilvusUtil:
         except Exception as e:
             logger.error("Milvus create collection error: {}", e)
 
+    def list_collections(self):
+        try:
+            status, collections = self.client.list_collections()
+            return collections
+        except Exception as e:
+            logger.error("Milvus list collections error: {}", e)
+            return []
+
     def drop_collection(self, name):
         try:
             status = self.client.drop_collection(name)
@@ -39,14 +70,12 @@ class MilvusUtil:
             logger.error("Milvus drop collection error: {}", e)
 
     def create_index(self, name):
-        param = {'nlist': 1000}
-        try:
-            status = self.client.create_index(name, IndexType.IVF_FLAT,
-                                              param)
-            logger.debug(status)
-            return status
-        except Exception as e:
-            logger.error("Milvus create index error: {}", e)
+        """按当前数据量立即（同步）建索引"""
+        collection = self._target(name)[0]
+        return self.indexes.build(collection, *self.indexes.plan(collection, force=True))
+
+    def search_params(self, name, top_k):
+        return self.indexes.search_params(self._target(name)[0], top_k)
 
     def insert(self, name, vectors, ids=None):
         try:
@@ -55,34 +84,153 @@ class MilvusUtil:
             # self.create_index(name)
             # logger.debug('collection info: {}'.format(
             #     self.client.get_collection_info(collection_name)[1]))
-            status, ids = self.client.insert(collection_name=name,
+            vectors = np.asarray(vectors, dtype=vector.DTYPE).tolist()  # numpy 矩阵或若干行
+            collection, tag = self._target(name)
+            status, ids = self.client.insert(collection_name=collection,
                                              records=vectors,
-                                             ids=ids)
-            self.client.flush([name])
-            logger.debug(
-                'Insert {} entities, there are {} entities after insert data.'.
-                format(len(ids),
-                       self.client.count_entities(name)[1]))
+                                             ids=ids,
+                                             partition_tag=tag)
+            _check(status, 'insert')
+            if self.auto_flush:
+                _check(self.client.flush([collection]), 'flush')
+                self.indexes.maybe_build(collection)
+            # lazy: 只有开启 debug 日志时才调用 count_entities
+            logger.opt(lazy=True).debug('Insert {} entities, there are {} entities after insert data.',
+                                        lambda: len(ids), lambda: self.client.count_entities(collection)[1])
             return status, ids
         except Exception as e:
             logger.error("Milvus insert error: {}", e)
+            raise
 
     def delete(self, name, ids):
         try:
-            status = self.client.delete_entity_by_id(name, ids)
-            self.client.flush([name])
+            collection, tag = self._target(name)
+            status = self.client.delete_entity_by_id(collection, ids, partition_tag=tag)
+            _check(status, 'delete')
+            if self.auto_flush:
+                _check(self.client.flush([collection]), 'flush')
             return status
         except Exception as e:
             logger.error('Milvus delete error: {}', e)
+            raise
 
-    def search(self, name, vector, top_k):
-        # param = {'nprobe': 20}
+    def flush(self, names=None):
         try:
+            if names is not None:
+                names = list({self._target(name)[0] for name in names})
+            status = self.client.flush(names)
+            _check(status, 'flush')
+            for collection in names or []:
+                self.indexes.maybe_build(collection)
+            return status
+        except Exception as e:
+            logger.error('Milvus flush error: {}', e)
+            raise
+
+    def batch_search(self, name, vectors, top_k, version=None, params=None, **kwargs):
+        try:
+            vectors = np.asarray(vectors, dtype=vector.DTYPE).tolist()
+            collection, tags = self._search_target(name, version)
+            if tags is not None and not tags:
+                return [[] for _ in vectors]
+            if params is None:
+                params = self.indexes.search_params(collection, top_k)
             status, results = self.client.search(
-                collection_name=name,
-                query_records=[vector],  # 可以批量
-                top_k=top_k)
-            # params=param)
-            return status, results
+                collection_name=collection,
+                query_records=vectors,
+                top_k=top_k,
+                partition_tags=tags,
+                params=params)
+            if not status.OK():
+                logger.error('Milvus search error: {}', status)
+                return None
+            output = []
+            for row in results:
+                # 同一问题可能出现在多个公开问题库的 partition 中，按距离升序只保留第一次
+                seen = set()
+                hits = []
+                for item in row:
+                    if item.id not in seen:
+                        seen.add(item.id)
+                        hits.append(Hit(item.id, item.distance))
+                output.append(hits)
+            return output
         except Exception as e:
             logger.error('Milvus search error: {}', e)
+
+
+def load_public_partitions():
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT id FROM question_set WHERE permission = 'public' AND id != 1")).all()
+    return ['_' + str(row.id) for row in rows]
+
+
+class MilvusPartitionUtil(MilvusUtil):
+    """所有问题库共用一个 collection，每个问题库一个 partition（tag 为 '_<sid>'）。
+
+    公开库 _1 不再另存一份向量：检索 _1 时在所有公开问题库的 partition 中检索，
+    设为公开/私有只需修改数据库中的 permission。
+    """
+    stores_public_copy = False
+
+    def __init__(self, collection, auto_flush=True):
+        super().__init__(auto_flush)
+        self.collection = collection
+        self._public = (None, None)  # (公开库的 generation, partition tags)
+
+    def _target(self, name):
+        return self.collection, name
+
+    def _search_target(self, name, version=None):
+        if name != '_1':
+            return self.collection, [name]
+        cached_version, tags = self._public
+        if tags is None or version is None or cached_version != version:
+            tags = load_public_partitions()
+            self._public = (version, tags)
+        return self.collection, tags
+
+    def has_collection(self, name):
+        try:
+            status, ok = self.client.has_partition(self.collection, name)
+            return ok
+        except Exception as e:
+            logger.error("Milvus has_partition error: {}", e)
+
+    def create_collection(self, name):
+        if not super().has_collection(self.collection):
+            super().create_collection(self.collection)
+        if name == '_1':
+            return
+        try:
+            status = self.client.create_partition(self.collection, name)
+            logger.debug(status)
+            return status
+        except Exception as e:
+            logger.error("Milvus create partition error: {}", e)
+
+    def drop_collection(self, name):
+        try:
+            status = self.client.drop_partition(self.collection, name)
+            logger.debug(status)
+            return status
+        except Exception as e:
+            logger.error("Milvus drop partition error: {}", e)
+
+    def list_collections(self):
+        try:
+            status, partitions = self.client.list_partitions(self.collection)
+            return [partition.tag for partition in partitions if partition.tag != '_default']
+        except Exception as e:
+            logger.error("Milvus list partitions error: {}", e)
+            return []
+
+    def insert(self, name, vectors, ids=None):
+        if name == '_1':
+            return None, ids
+        return super().insert(name, vectors, ids)
+
+    def delete(self, name, ids):
+        if name == '_1':
+            return
+        return super().delete(name, ids)
@@ -0,0 +1,175 @@
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import text
+
+from . import vector
+from .database import engine
+from .vector_index import VectorIndex, Hit
+
+Loader = Callable[[str, Optional[int]], Optional[Tuple[np.ndarray, np.ndarray]]]
+
+
+def load_from_db(name, max_size=None):
+    """从 Postgres 读出问题库的全部向量；超过 max_size 时返回 None"""
+    sid = int(name.lstrip('_'))
+    with engine.connect() as conn:
+        if max_size is not None:
+            count = conn.execute(text('SELECT count(*) FROM set2question WHERE set_id = :sid'),
+                                 {'sid': sid}).scalar()
+            if count > max_size:
+                return None
+        rows = conn.execute(text("SELECT q.id, q.embedding FROM set2question s "
+                                 "JOIN question q ON q.id = s.question_id "
+                                 "WHERE s.set_id = :sid AND q.embedding != ''::bytea ORDER BY q.id"),
+                            {'sid': sid}).all()
+    ids = np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows))
+    return ids, vector.stack([row.embedding for row in rows])
+
+
+class _Collection:
+    def __init__(self, ids, vectors, version=None):
+        self.ids = ids
+        self.vectors = np.ascontiguousarray(vectors, dtype=vector.DTYPE)
+        self.norms = (self.vectors * self.vectors).sum(axis=1)
+        self.version = version
+
+
+class NumpyIndex(VectorIndex):
+    """进程内精确检索：每个 collection 一块连续的 float32 矩阵，向量化计算 L2 top-k。
+
+    有 loader 时，未加载或 version 变化（其他进程改了问题库）的 collection 会从数据库重新加载。
+    """
+
+    def __init__(self, loader: Optional[Loader] = None):
+        self.loader = loader
+        self._collections: Dict[str, Optional[_Collection]] = {}
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def has_collection(self, name):
+        return name in self._collections
+
+    def create_collection(self, name):
+        with self._lock:
+            self._collections.setdefault(name, _Collection(np.empty(0, np.int64),
+                                                           np.empty((0, vector.DIM), vector.DTYPE)))
+
+    def drop_collection(self, name):
+        self.evict(name)
+
+    def list_collections(self):
+        return list(self._collections)
+
+    def evict(self, name):
+        with self._lock:
+            self._collections.pop(name, None)
+            self._versions.pop(name, None)
+
+    def ensure_loaded(self, name, version=None, max_size=None):
+        """返回 collection 是否可以在本地检索；过大的 collection 记为 None，直到 version 变化"""
+        with self._lock:
+            loaded = name in self._collections
+            if loaded and (version is None or self._versions.get(name) == version):
+                return self._collections[name] is not None
+        if self.loader is None:
+            return loaded
+        data = self.loader(name, max_size)
+        with self._lock:
+            self._collections[name] = _Collection(*data) if data is not None else None
+            if version is not None:
+                self._versions[name] = version
+        return data is not None
+
+    def insert(self, name, vectors, ids=None):
+        vectors = np.asarray(vectors, dtype=vector.DTYPE).reshape(-1, vector.DIM)
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:  # 未加载，检索时再从数据库读
+                return
+            keep = ~np.isin(collection.ids, ids)
+            self._collections[name] = _Collection(np.concatenate([collection.ids[keep], ids]),
+                                                   np.concatenate([collection.vectors[keep], vectors]))
+
+    def delete(self, name, ids):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                return
+            keep = ~np.isin(collection.ids, np.asarray(ids, dtype=np.int64))
+            self._collections[name] = _Collection(collection.ids[keep], collection.vectors[keep])
+
+    def batch_search(self, name, vectors, top_k, version=None, **kwargs) -> List[List[Hit]]:
+        if not self.ensure_loaded(name, version):
+            return None
+        collection = self._collections.get(name)
+        if collection is None:
+            return None
+        queries = np.asarray(vectors, dtype=vector.DTYPE).reshape(-1, vector.DIM)
+        n = len(collection.ids)
+        if n == 0:
+            return [[] for _ in range(len(queries))]
+        k = min(top_k, n)
+        # |q - v|^2 = |v|^2 - 2 q·v + |q|^2
+        distances = collection.norms[None, :] - 2 * queries @ collection.vectors.T \
+            + (queries * queries).sum(axis=1)[:, None]
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        top_distances = np.take_along_axis(distances, top, axis=1)
+        order = np.argsort(top_distances, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_distances = np.maximum(np.take_along_axis(top_distances, order, axis=1), 0)
+        return [[Hit(int(collection.ids[j]), float(d)) for j, d in zip(row, row_distances)]
+                for row, row_distances in zip(top, top_distances)]
+
+
+class TieredIndex(VectorIndex):
+    """写入全部进入 remote（milvus）；不超过 max_local_size 的 collection 在进程内检索"""
+
+    def __init__(self, remote: VectorIndex, local: NumpyIndex, max_local_size):
+        self.remote = remote
+        self.local = local
+        self.max_local_size = max_local_size
+
+    @property
+    def stores_public_copy(self):
+        return self.remote.stores_public_copy
+
+    def search_params(self, name, top_k):
+        return self.remote.search_params(name, top_k)
+
+    def has_collection(self, name):
+        return self.remote.has_collection(name)
+
+    def create_collection(self, name):
+        return self.remote.create_collection(name)
+
+    def drop_collection(self, name):
+        self.local.evict(name)
+        return self.remote.drop_collection(name)
+
+    def list_collections(self):
+        return self.remote.list_collections()
+
+    def insert(self, name, vectors, ids=None):
+        self.local.insert(name, vectors, ids)
+        return self.remote.insert(name, vectors, ids)
+
+    def delete(self, name, ids):
+        self.local.delete(name, ids)
+        return self.remote.delete(name, ids)
+
+    def flush(self, names=None):
+        return self.remote.flush(names)
+
+    def close(self):
+        return self.remote.close()
+
+    def add_flush_listener(self, listener):
+        return self.remote.add_flush_listener(listener)
+
+    def batch_search(self, name, vectors, top_k, version=None, **kwargs):
+        if self.local.ensure_loaded(name, version, self.max_local_size):
+            return self.local.batch_search(name, vectors, top_k)
+        return self.remote.batch_search(name, vectors, top_k, version=version, **kwargs)
@@ -1,16 +1,26 @@
+import base64
+import binascii
+import json
+from datetime import datetime
 from math import ceil
 
+from sqlalchemy import select, func, text, tuple_, DateTime
+from sqlalchemy.dialects import postgresql
+
 
 class Pagination(object):
-    def __init__(self, query, page, per_page, total, items):
+    def __init__(self, query, page, per_page, total, items, next_cursor=None):
         self.query = query
         self.page = page
         self.per_page = per_page
         self.total = total
         self.items = items
+        self.next_cursor = next_cursor
 
     @property
     def pages(self):
+        if self.total is None:
+            return None
         if self.per_page == 0:
             pages = 0
         else:
@@ -23,6 +33,7 @@ class Pagination(object):
         model.total = self.total
         model.pages = self.pages
         model.items = self.items
+        model.next_cursor = self.next_cursor
 
     def prev(self):
         assert self.query is not None, 'a query object is required for this method to work'
@@ -68,3 +79,92 @@ def paginate(self, page=None, per_page=None):
         total = self.order_by(None).count()
 
     return Pagination(self, page, per_page, total, items)
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, keys):
+    """cursor 无法解析时抛出 ValueError"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError('cursor length mismatch')
+        return [datetime.fromisoformat(value) if isinstance(key.type, DateTime) else value
+                for key, value in zip(keys, values)]
+    except (TypeError, UnicodeError, json.JSONDecodeError, binascii.Error) as e:
+        raise ValueError(str(e))
+
+
+async def _estimate_count(db, stmt):
+    """用 EXPLAIN 的行数估计代替 COUNT(*)，不扫描数据"""
+    compiled = stmt.order_by(None).compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True})
+    plan = (await db.execute(text('EXPLAIN (FORMAT JSON) ' + str(compiled)))).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+async def _count(db, stmt, total, seen):
+    """seen: 已知至少有多少行（之前各页 + 本页 + 有下一页时的 1 行），估计值不会小于它"""
+    if total == 'none':
+        return None
+    if total == 'estimate':
+        return max(await _estimate_count(db, stmt), seen)
+    return (await db.execute(select(func.count()).select_from(stmt.order_by(None).subquery()))).scalar()
+
+
+async def _fetch(db, stmt, keys, per_page):
+    """多取一行判断是否有下一页；keys 可以是其他表（如排序用的子查询）的列，和实体一起取出"""
+    if not keys:
+        items = (await db.execute(stmt.limit(per_page + 1))).scalars().all()
+        return items[:per_page], len(items) > per_page, None
+    rows = (await db.execute(stmt.add_columns(*keys).limit(per_page + 1))).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = encode_cursor(list(rows[-1][1:])) if has_next else None
+    return [row[0] for row in rows], has_next, next_cursor
+
+
+async def async_paginate(db, stmt, page=None, per_page=None, total='exact', keys=None):
+    """AsyncSession 版本的 paginate，stmt 为 select(Model)
+
+    total: exact 精确计数 / estimate 按执行计划估计 / none 不计数
+    keys: 按这些列倒序排列，并返回可用于 async_keyset_paginate 的 next_cursor
+    """
+    if page is None:
+        page = 1
+
+    if per_page is None:
+        per_page = 10
+
+    if keys:
+        stmt = stmt.order_by(*[key.desc() for key in keys])
+    items, has_next, next_cursor = await _fetch(db, stmt.offset((page - 1) * per_page), keys, per_page)
+
+    if not has_next and (items or page == 1):  # 最后一页，不需要再计数
+        count = (page - 1) * per_page + len(items)
+    else:
+        count = await _count(db, stmt, total, (page - 1) * per_page + len(items) + has_next)
+
+    return Pagination(None, page, per_page, count, items, next_cursor)
+
+
+async def async_keyset_paginate(db, stmt, keys, cursor, per_page=None, total='exact'):
+    """按 keys 倒序的游标分页，深翻页与第一页一样快；cursor 为上一页返回的 next_cursor，None 表示第一页"""
+    if per_page is None:
+        per_page = 10
+
+    page_stmt = stmt.order_by(*[key.desc() for key in keys])
+    if cursor:
+        page_stmt = page_stmt.where(tuple_(*keys) < tuple_(*decode_cursor(cursor, keys)))
+    items, has_next, next_cursor = await _fetch(db, page_stmt, keys, per_page)
+
+    if not cursor and not has_next:
+        count = len(items)
+    else:
+        count = await _count(db, stmt, total, len(items) + has_next)
+
+    return Pagination(None, None, per_page, count, items, next_cursor)
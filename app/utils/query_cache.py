@@ -0,0 +1,49 @@
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+from .rocketqa import normalize_query
+from .database import SessionLocal
+from ..config import settings
+from ..models.models import QuestionSet, EnumPermission
+
+result_cache = TTLCache('query_result', settings.query_cache_size, settings.query_cache_ttl)
+
+
+def _key(question_set: QuestionSet, query, top_k, mode):
+    return question_set.id, question_set.generation, normalize_query(query), top_k, mode
+
+
+def get(question_set: QuestionSet, query, top_k, mode='vector'):
+    return result_cache.get(_key(question_set, query, top_k, mode))
+
+
+def put(question_set: QuestionSet, query, top_k, result, mode='vector'):
+    result_cache.set(_key(question_set, query, top_k, mode), result)
+
+
+def invalidate(db: Session, sids, public=False):
+    """递增问题库的 generation，旧条目不再被命中，由 LRU/TTL 自然淘汰。
+
+    generation 存在数据库里，多个 worker 进程都能看到；需要调用者 commit。
+    公开库的变化同样会影响 _1。
+    """
+    sids = set(sids)
+    if public:
+        sids.add(1)
+    if not sids:
+        return
+    db.query(QuestionSet).filter(QuestionSet.id.in_(sids)) \
+        .update({QuestionSet.generation: QuestionSet.generation + 1}, synchronize_session=False)
+
+
+def invalidate_collections(names):
+    """向量延迟写入 milvus 后再递增一次 generation，丢弃写入可见前缓存的结果。
+
+    partition 布局下公开问题库的写入不会出现 _1，flush 的问题库中有公开的时同样递增公开库。
+    """
+    sids = {int(name.lstrip('_')) for name in names}
+    with SessionLocal() as db:
+        public = db.query(QuestionSet.id).filter(QuestionSet.id.in_(sids), QuestionSet.id != 1,
+                                                 QuestionSet.permission == EnumPermission.public).first() is not None
+        invalidate(db, sids, public)
+        db.commit()
@@ -1,40 +1,236 @@
+import asyncio
 import json
+import re
+import time
+import unicodedata
+from typing import Optional
 
 import httpx
+import numpy as np
 from loguru import logger
 
+from . import vector
+from .cache import TTLCache
+from .metrics import rocketqa_batch_size, rocketqa_batch_queue_wait, rocketqa_batch_window
 from ..config import settings
 
+embedding_cache = TTLCache('query_embedding', settings.embedding_cache_size, settings.embedding_cache_ttl)
+
+# 长连接池，在 startup 时创建，shutdown 时关闭
+_client: Optional[httpx.AsyncClient] = None
+_sync_client: Optional[httpx.Client] = None
+
+
+class QueryBatcher:
+    """把窗口期内并发的 step 1 编码合并成一次请求，再把结果分发回各个调用者"""
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # 事件循环只弱引用 task，正在发送的批次需要保留引用，否则可能被回收，调用者永远等不到结果
+        self._sending = set()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        rocketqa_batch_window.set(self.window)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError('RocketQA client is shutting down'))
+
+    async def encode(self, query):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((query, future, time.monotonic()))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # 发送不阻塞下一批的收集
+            task = asyncio.create_task(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    @staticmethod
+    async def _send(batch):
+        now = time.monotonic()
+        for _, _, enqueued_at in batch:
+            rocketqa_batch_queue_wait.observe(now - enqueued_at)
+        queries = list(dict.fromkeys(query for query, _, _ in batch))
+        rocketqa_batch_size.observe(len(queries))
+        try:
+            embeddings = await _encode_queries(queries)
+            if len(embeddings) != len(queries):
+                raise ValueError(f'RocketQA returned {len(embeddings)} embeddings for {len(queries)} queries')
+            result = dict(zip(queries, embeddings))
+            for query, future, _ in batch:
+                if not future.done():  # 调用者可能已经取消
+                    future.set_result(result[query])
+        except Exception as e:
+            # 任何异常都要让所有调用者返回，否则它们会一直等待
+            logger.error('RocketQA batch encode error: {}', e)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+_batcher: Optional[QueryBatcher] = None
+
+
+def _limits():
+    return httpx.Limits(max_connections=settings.rocketqa_max_connections,
+                        max_keepalive_connections=settings.rocketqa_max_keepalive,
+                        keepalive_expiry=settings.rocketqa_keepalive_expiry)
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(limits=_limits(), timeout=settings.rocketqa_timeout)
+    return _client
+
+
+def _get_sync_client() -> httpx.Client:
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = httpx.Client(limits=_limits(), timeout=settings.rocketqa_timeout)
+    return _sync_client
+
+
+async def startup():
+    global _batcher
+    _get_client()
+    if settings.rocketqa_batch_window > 0:
+        _batcher = QueryBatcher(settings.rocketqa_batch_window, settings.rocketqa_batch_max_size)
+        _batcher.start()
+
+
+async def shutdown():
+    global _client, _sync_client, _batcher
+    if _batcher is not None:
+        await _batcher.stop()
+        _batcher = None
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
+
+
+BINARY_TYPE = 'application/octet-stream'
+
+
+def _headers():
+    # 服务端不支持二进制格式时会忽略 Accept，返回 JSON
+    if settings.rocketqa_binary:
+        return {'Accept': f'{BINARY_TYPE}, application/json;q=0.5'}
+    return {}
+
+
+def _decode(response: httpx.Response) -> np.ndarray:
+    """返回 (n, DIM) 的 float32 矩阵；二进制格式直接映射响应内容，不经过 Python float 列表"""
+    if response.headers.get('content-type', '').startswith(BINARY_TYPE):
+        rows, dim = (int(n) for n in response.headers['x-shape'].split(','))
+        return np.frombuffer(response.content, dtype=vector.DTYPE).reshape(rows, dim)
+    res_json = json.loads(response.text)
+    return np.asarray(res_json['result'], dtype=vector.DTYPE)
+
+
+def _post(input_data, **kwargs) -> np.ndarray:
+    return _decode(_get_sync_client().post(settings.rocketqa_url, json=input_data, headers=_headers(), **kwargs))
+
+
+async def _async_post(input_data, **kwargs) -> np.ndarray:
+    return _decode(await _get_client().post(settings.rocketqa_url, json=input_data, headers=_headers(), **kwargs))
+
+
+def normalize_query(query):
+    """全角转半角、去首尾空白、合并连续空白、小写"""
+    query = unicodedata.normalize('NFKC', query)
+    return re.sub(r'\s+', ' ', query).strip().lower()
+
 
 def get_embedding(query):
-    input_data = {'step': 1, 'query': [query]}
-    result = httpx.post(settings.rocketqa_url, json=input_data, timeout=30.0)
-    res_json = json.loads(result.text)
-    return res_json['result'][0]
+    key = normalize_query(query)
+    embedding = embedding_cache.get(key)
+    if embedding is not None:
+        return embedding
+    input_data = {'step': 1, 'query': [key]}
+    embedding = _post(input_data)[0]
+    embedding_cache.set(key, embedding)
+    return embedding
+
+
+async def _encode_queries(queries):
+    input_data = {'step': 1, 'query': queries}
+    return await _async_post(input_data)
+
+
+async def async_get_embedding(query):
+    key = normalize_query(query)
+    embedding = embedding_cache.get(key)
+    if embedding is not None:
+        return embedding
+    if _batcher is not None:
+        embedding = await _batcher.encode(key)
+    else:
+        embedding = (await _encode_queries([key]))[0]
+    embedding_cache.set(key, embedding)
+    return embedding
+
+
+async def async_get_embeddings(queries):
+    """批量编码查询：缓存未命中的合并为一次 step 1 请求，返回顺序与 queries 一致"""
+    keys = [normalize_query(query) for query in queries]
+    embeddings = [embedding_cache.get(key) for key in keys]
+    missing = list(dict.fromkeys(key for key, embedding in zip(keys, embeddings) if embedding is None))
+    if missing:
+        encoded = dict(zip(missing, await _encode_queries(missing)))
+        for key, embedding in encoded.items():
+            embedding_cache.set(key, embedding)
+        embeddings = [embedding if embedding is not None else encoded[key]
+                      for key, embedding in zip(keys, embeddings)]
+    return embeddings
 
 
 def get_para(title, para):
     input_data = {'step': 3, 'titles': [title], 'paras': [para]}
-    result = httpx.post(settings.rocketqa_url, json=input_data, timeout=30.0)
-    res_json = json.loads(result.text)
-    return res_json['result'][0]
+    return _post(input_data)[0]
 
 
 async def async_get_para(title, para):
     input_data = {'step': 3, 'titles': [title], 'paras': [para]}
-    async with httpx.AsyncClient() as client:
-        result = await client.post(settings.rocketqa_url, json=input_data, timeout=30.0)
-        res_json = json.loads(result.text)
-        return res_json['result'][0]
+    return (await _async_post(input_data))[0]
 
 
 async def async_get_paras(titles, paras):
     input_data = {'step': 3, 'titles': titles, 'paras': paras}
-    async with httpx.AsyncClient() as client:
-        result = await client.post(settings.rocketqa_url, json=input_data, timeout=None)
-        logger.debug(result)
-        res_json = json.loads(result.text)
-        return res_json['result']
+    return await _async_post(input_data, timeout=settings.rocketqa_bulk_timeout)
 
 # def matching(query, titles):
 #     input_data = {'step': 2, 'query': query, 'titles': titles, 'paras': ['-' for i in range(len(titles))]}
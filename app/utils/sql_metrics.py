@@ -0,0 +1,96 @@
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+from .metrics import sql_statements, sql_seconds, db_pool_wait, db_pool_in_use, db_pool_saturation
+from ..config import settings
+
+_PARAM = re.compile(r'%\(\w+\)s|\$\d+|%s')
+_PARAM_LIST = re.compile(r'\?(\s*,\s*\?)+')
+
+
+def statement_shape(statement):
+    """去掉参数名与 IN 列表长度的差异，同一处代码生成的语句得到相同的形状"""
+    return _PARAM_LIST.sub('?', _PARAM.sub('?', statement))
+
+
+class RequestStats:
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.seconds += elapsed
+        shape = statement_shape(statement)
+        self.shapes[shape] += 1
+        if self.shapes[shape] == settings.sql_repeat_warn_threshold + 1:
+            logger.warning('Possible N+1 in {}: statement ran more than {} times: {}',
+                           self.path, settings.sql_repeat_warn_threshold, shape)
+
+
+# 由中间件在每个请求开始时设置；线程池与 greenlet 都会继承当前 context
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+
+
+def start_request(path) -> RequestStats:
+    stats = RequestStats(path)
+    _request_stats.set(stats)
+    return stats
+
+
+def finish_request(stats: RequestStats, route):
+    sql_statements.labels(route).observe(stats.count)
+    sql_seconds.labels(route).observe(stats.seconds)
+
+
+class _TimedGetMixin:
+    label = ''
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait.labels(self.label).observe(time.perf_counter() - start)
+
+
+class TimedQueuePool(_TimedGetMixin, QueuePool):
+    label = 'sync'
+
+
+class TimedAsyncAdaptedQueuePool(_TimedGetMixin, AsyncAdaptedQueuePool):
+    label = 'async'
+
+
+def instrument_engine(engine, label):
+    """记录每条语句的耗时到当前请求，以及连接池的占用情况"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.record(statement, elapsed)
+
+    pool = engine.pool
+
+    def _update_pool(*args):
+        in_use = pool.checkedout()
+        db_pool_in_use.labels(label).set(in_use)
+        db_pool_saturation.labels(label).set(in_use / max(pool.size() + max(pool._max_overflow, 0), 1))
+
+    event.listen(pool, 'checkout', _update_pool)
+    event.listen(pool, 'checkin', _update_pool)
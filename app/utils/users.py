@@ -0,0 +1,31 @@
+from typing import NamedTuple, Optional
+
+from sqlalchemy import select
+
+from .cache import TTLCache
+from .database import AsyncSessionLocal
+from ..config import settings
+from ..models.models import User, EnumRole
+
+
+class CurrentUser(NamedTuple):
+    """请求中使用的只读用户信息，不进入 Session 的 identity map"""
+    id: int
+    name: str
+    role: EnumRole
+
+
+# 每个进程各有一份，不主动失效；角色变化后最多晚 user_cache_ttl 秒看到
+user_cache = TTLCache('user', settings.user_cache_size, settings.user_cache_ttl)
+
+
+async def load_user(user_id: int) -> Optional[CurrentUser]:
+    user = user_cache.get(user_id)
+    if user is None:
+        async with AsyncSessionLocal() as db:
+            row = (await db.execute(select(User.id, User.name, User.role).where(User.id == user_id))).one_or_none()
+        if row is None:
+            return None
+        user = CurrentUser(*row)
+        user_cache.set(user_id, user)
+    return user
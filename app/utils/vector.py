@@ -0,0 +1,19 @@
+import numpy as np
+
+# zh_dureader_de_v2 的向量维度
+DIM = 768
+DTYPE = np.dtype('<f4')
+
+
+def to_bytes(vector) -> bytes:
+    """float32 小端序，768 维约 3 KB"""
+    return np.asarray(vector, dtype=DTYPE).tobytes()
+
+
+def from_bytes(data) -> np.ndarray:
+    return np.frombuffer(data, dtype=DTYPE)
+
+
+def stack(blobs) -> np.ndarray:
+    """把多行的二进制向量一次解码为 (n, DIM) 的矩阵，不逐行解析"""
+    return np.frombuffer(b''.join(blobs), dtype=DTYPE).reshape(-1, DIM)
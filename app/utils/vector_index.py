@@ -0,0 +1,64 @@
+from abc import ABC, abstractmethod
+from typing import List, NamedTuple
+
+
+class Hit(NamedTuple):
+    id: int
+    distance: float
+
+
+class VectorIndexError(Exception):
+    """写入、删除或 flush 失败；调用者需要重试，不能当作已写入"""
+
+
+class VectorIndex(ABC):
+    """向量检索后端。collection 名为 '_<sid>'，距离为 L2"""
+    # 为 False 时公开库 _1 的向量由后端从各公开问题库推导，调用方不必再写入 _1
+    stores_public_copy = True
+
+    @abstractmethod
+    def has_collection(self, name):
+        pass
+
+    @abstractmethod
+    def create_collection(self, name):
+        pass
+
+    @abstractmethod
+    def drop_collection(self, name):
+        pass
+
+    @abstractmethod
+    def list_collections(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def insert(self, name, vectors, ids=None):
+        pass
+
+    @abstractmethod
+    def delete(self, name, ids):
+        pass
+
+    @abstractmethod
+    def batch_search(self, name, vectors, top_k, **kwargs) -> List[List[Hit]]:
+        """kwargs 中的 version 为问题库的 generation，供进程内后端判断是否需要重新加载"""
+
+    def search_params(self, name, top_k):
+        """与 collection 当前索引对应的检索参数，如 {'nprobe': 32}；没有索引时为 None"""
+        return None
+
+    def flush(self, names=None):
+        """让之前的写入可见；默认实现写入即可见"""
+
+    def close(self):
+        pass
+
+    def add_flush_listener(self, listener):
+        """listener(names) 在写入真正可见后调用；默认写入即可见，无需回调"""
+
+    def search(self, name, vector, top_k, **kwargs) -> List[Hit]:
+        results = self.batch_search(name, [vector], top_k, **kwargs)
+        if results is None:
+            return None
+        return results[0]
@@ -0,0 +1,223 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from loguru import logger
+
+from . import vector
+from .metrics import vector_write_buffer_depth, vector_write_flush_seconds
+from .vector_index import VectorIndex, VectorIndexError
+
+
+class _Pending:
+    def __init__(self):
+        self.inserts = {}  # id -> vector
+        self.deletes = set()
+        self.fresh = set()  # 缓冲区里新插入、之前没有删除过的 id
+        self.since = time.monotonic()
+
+    def __len__(self):
+        return len(self.inserts) + len(self.deletes)
+
+    def insert(self, qid, vec):
+        self.inserts[qid] = vec
+        if qid not in self.deletes:
+            self.fresh.add(qid)
+
+    def delete(self, qid):
+        self.inserts.pop(qid, None)
+        if qid in self.fresh:
+            self.fresh.discard(qid)
+            return
+        self.deletes.add(qid)
+
+    def then(self, newer: '_Pending'):
+        """写入失败的一批放回缓冲区：在它之后到达的 newer 按 flush 的顺序（先删后插）叠加在上面"""
+        for qid in newer.deletes:
+            self.delete(qid)
+        for qid, vec in newer.inserts.items():
+            self.insert(qid, vec)
+        return self
+
+
+class WriteBehindIndex(VectorIndex):
+    """合并各个请求对同一 collection 的插入与删除。
+
+    攒够 max_pending 条、最早的写入超过 max_age 秒，或调用 flush() 时，
+    先删除后插入写入下层后端，每个 collection 只 flush 一次。
+    缓冲区内先插入后删除的 id 直接抵消。
+    写入下层后端失败的批次放回缓冲区重试，flush() 抛出 VectorIndexError，调用者不能当作已写入。
+
+    攒够条数后的 flush 与 listener 都在后台线程中执行：listener 会打开新的数据库会话修改 question_set，
+    在调用者（可能持有同一行的锁、尚未 commit）的线程里执行会互相等待。
+    """
+
+    def __init__(self, backend: VectorIndex, max_pending, max_age):
+        self.backend = backend
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.listeners: List[Callable[[List[str]], None]] = []  # flush 完成后回调
+        self._pending: Dict[str, _Pending] = {}
+        self._unflushed = set()  # 已写入下层后端但 backend.flush 失败的 collection
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()  # 有 collection 攒够条数或有待通知的 listener
+        self._notify = []  # 已 flush、尚未通知 listener 的 collection
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='vector-write-behind', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.max_age / 2)
+            self._wake.clear()
+            now = time.monotonic()
+            with self._lock:
+                full = [name for name, pending in self._pending.items() if len(pending) >= self.max_pending]
+                aged = [name for name, pending in self._pending.items()
+                        if name not in full and now - pending.since >= self.max_age]
+                aged += [name for name in self._unflushed if name not in full and name not in aged]
+            for names, reason in ((full, 'size'), (aged, 'age')):
+                if not names:
+                    continue
+                try:
+                    self.flush(names, reason=reason)
+                except Exception as e:
+                    # 失败的写入已放回缓冲区，下一轮重试
+                    logger.error('write-behind flush error: {}', e)
+            self._notify_listeners()
+
+    def _notify_listeners(self):
+        with self._lock:
+            names, self._notify = list(dict.fromkeys(self._notify)), []
+        if not names:
+            return
+        for listener in self.listeners:
+            try:
+                listener(names)
+            except Exception as e:
+                logger.error('write-behind listener error: {}', e)
+
+    def add_flush_listener(self, listener):
+        self.listeners.append(listener)
+
+    @property
+    def stores_public_copy(self):
+        return self.backend.stores_public_copy
+
+    def search_params(self, name, top_k):
+        return self.backend.search_params(name, top_k)
+
+    def has_collection(self, name):
+        return self.backend.has_collection(name)
+
+    def create_collection(self, name):
+        return self.backend.create_collection(name)
+
+    def drop_collection(self, name):
+        with self._lock:
+            self._pending.pop(name, None)
+        vector_write_buffer_depth.labels(name).set(0)
+        return self.backend.drop_collection(name)
+
+    def list_collections(self):
+        return self.backend.list_collections()
+
+    def insert(self, name, vectors, ids=None):
+        vectors = np.asarray(vectors, dtype=vector.DTYPE).reshape(-1, vector.DIM)
+        with self._lock:
+            pending = self._pending.setdefault(name, _Pending())
+            for qid, vec in zip(ids, vectors):
+                pending.insert(qid, vec)
+            depth = len(pending)
+        self._after_write(name, depth)
+        return None, list(ids)
+
+    def delete(self, name, ids):
+        with self._lock:
+            pending = self._pending.setdefault(name, _Pending())
+            for qid in ids:
+                pending.delete(qid)
+            depth = len(pending)
+        self._after_write(name, depth)
+
+    def _after_write(self, name, depth):
+        vector_write_buffer_depth.labels(name).set(depth)
+        self._ensure_thread()
+        if depth >= self.max_pending:
+            self._wake.set()
+
+    def flush(self, names=None, reason='barrier'):
+        # _flush_lock 保证同一 collection 的两批写入不会乱序
+        with self._flush_lock:
+            with self._lock:
+                if names is None:
+                    names = list(self._pending) + [name for name in self._unflushed if name not in self._pending]
+                batches = [(name, self._pending.pop(name)) for name in names if name in self._pending]
+                flushed = [name for name in names if name in self._unflushed and name not in self._pending]
+                self._unflushed.difference_update(flushed)
+            if not batches and not flushed:
+                return
+            start = time.time()
+            failed = []
+            for name, pending in batches:
+                vector_write_buffer_depth.labels(name).set(0)
+                if not len(pending):
+                    continue
+                try:
+                    if pending.deletes:
+                        self.backend.delete(name, list(pending.deletes))
+                        pending.deletes.clear()  # 删除可以重复执行，插入成功前失败时只需重试插入
+                    if pending.inserts:
+                        self.backend.insert(name, np.stack(list(pending.inserts.values())), list(pending.inserts))
+                except Exception as e:
+                    failed.append((name, pending, e))
+                    continue
+                flushed.append(name)
+            if failed:
+                self._restore(failed)
+            if flushed:
+                try:
+                    self.backend.flush(flushed)
+                except Exception:
+                    with self._lock:
+                        self._unflushed.update(flushed)
+                    raise
+            vector_write_flush_seconds.labels(reason).observe(time.time() - start)
+        logger.debug('write-behind flushed {} ({})', flushed, reason)
+        if flushed:
+            with self._lock:
+                self._notify.extend(flushed)
+            self._ensure_thread()
+            self._wake.set()
+        if failed:
+            raise VectorIndexError(f'write-behind flush failed for {[name for name, _, _ in failed]}: {failed[0][2]}')
+
+    def _restore(self, failed):
+        """写入失败的批次放回缓冲区，之后到达的写入叠加在它上面，由后台线程或下一次 flush 重试"""
+        with self._lock:
+            for name, pending, e in failed:
+                logger.error('write-behind {} failed, {} writes kept for retry: {}', name, len(pending), e)
+                newer = self._pending.get(name)
+                self._pending[name] = pending.then(newer) if newer is not None else pending
+                vector_write_buffer_depth.labels(name).set(len(self._pending[name]))
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.flush(reason='barrier')
+        except Exception as e:
+            logger.error('write-behind final flush error, buffered writes are lost: {}', e)
+        self._notify_listeners()  # 关闭时调用者不在事务中，直接通知
+        self.backend.close()
+
+    def batch_search(self, name, vectors, top_k, **kwargs):
+        return self.backend.batch_search(name, vectors, top_k, **kwargs)
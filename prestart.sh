@@ -5,4 +5,9 @@ sleep 10
 # Run migrations
 # alembic upgrade head
 # Init
-python -m app.commands db-init
\ No newline at end of file
+python -m app.commands db-init
+python -m app.commands db-upgrade
+# 旧的 JSON 向量列转为 bytea，已迁移时直接返回
+python -m app.commands migrate-embedding
+# 升级后 question_gram 为空时建立关键词索引，已有索引时直接返回
+python -m app.commands keyword-index --if-empty
\ No newline at end of file
@@ -1,20 +1,134 @@
 # 修改自
 # https://github.com/PaddlePaddle/RocketQA/blob/main/examples/faiss_example/rocketqa_service.py
+import asyncio
 import json
+import logging
+import os
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+from prometheus_client import CollectorRegistry, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, \
+    multiprocess
 from tornado import ioloop, web, httpserver
 
 import rocketqa
 
+logger = logging.getLogger('rocketqa_service')
+
+# 一次推理最多的条数，以及凑批次时最多等待的秒数
+QUERY_BATCH_SIZE = int(os.environ.get('QUERY_BATCH_SIZE', 32))
+PARA_BATCH_SIZE = int(os.environ.get('PARA_BATCH_SIZE', 16))
+MAX_WAIT = float(os.environ.get('BATCH_MAX_WAIT', 0.005))
+
+queue_depth = Gauge('rocketqa_queue_depth', 'Texts waiting to be encoded', ['kind'], multiprocess_mode='livesum')
+batch_size = Histogram('rocketqa_batch_size', 'Texts per inference batch', ['kind'],
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+stage_seconds = Histogram('rocketqa_stage_seconds', 'Time spent per stage', ['kind', 'stage'])
+
+# 客户端在 Accept 中声明后，直接返回小端序 float32 的向量，形状放在 X-Shape 头中（"行数,维度"）
+BINARY_TYPE = 'application/octet-stream'
+
+
+class BatchScheduler:
+    """把各请求的编码放入 query / para 两个队列，凑成批次后在单独的线程里推理。
+
+    query 优先：只有 query 队列为空时才处理 para；大的 para 请求按批次拆开，
+    每批之间都会先检查 query 队列，所以 query 最多等待一个 para 批次。
+    """
+
+    def __init__(self, dual_encoder, batch_sizes, max_wait):
+        self._dual_encoder = dual_encoder
+        self._batch_sizes = batch_sizes
+        self._max_wait = max_wait
+        self._queues = {kind: deque() for kind in batch_sizes}
+        self._wakeup = None
+        # paddle 推理不在 IO 线程里，也不并发
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def encode(self, kind, inputs):
+        """inputs: query 为 [query]，para 为 [(title, para)]；返回 (n, dim) 的 float32 矩阵"""
+        if not inputs:
+            return np.zeros((0, 0), dtype=np.float32)
+        loop = asyncio.get_running_loop()
+        size = self._batch_sizes[kind]
+        futures = []
+        for i in range(0, len(inputs), size):
+            future = loop.create_future()
+            self._queues[kind].append((inputs[i:i + size], future, time.perf_counter()))
+            futures.append(future)
+        queue_depth.labels(kind).inc(len(inputs))
+        self._wakeup.set()
+        return np.concatenate(await asyncio.gather(*futures))
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            kind = 'query' if self._queues['query'] else 'para' if self._queues['para'] else None
+            if kind is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            batch = await self._collect(kind)
+            if batch:
+                await self._infer(kind, batch)
+
+    async def _collect(self, kind):
+        """等到凑满一批或最早的请求已等待 max_wait；等待期间来了 query 时先让给 query"""
+        queue, limit = self._queues[kind], self._batch_sizes[kind]
+        deadline = queue[0][2] + self._max_wait
+        while sum(len(item[0]) for item in queue) < limit and time.perf_counter() < deadline:
+            await asyncio.sleep(deadline - time.perf_counter())
+            if kind == 'para' and self._queues['query']:
+                return []
+        batch, count = [], 0
+        while queue and count + len(queue[0][0]) <= limit:
+            item = queue.popleft()
+            batch.append(item)
+            count += len(item[0])
+        return batch
+
+    def _encode(self, kind, inputs):
+        if kind == 'query':
+            embs = self._dual_encoder.encode_query(query=inputs)
+        else:
+            titles, paras = zip(*inputs)
+            embs = self._dual_encoder.encode_para(title=list(titles), para=list(paras))
+        return np.asarray(list(embs), dtype=np.float32)
+
+    async def _infer(self, kind, batch):
+        inputs = [x for item in batch for x in item[0]]
+        start = time.perf_counter()
+        for _, _, enqueued in batch:
+            stage_seconds.labels(kind, 'queue').observe(start - enqueued)
+        queue_depth.labels(kind).dec(len(inputs))
+        batch_size.labels(kind).observe(len(inputs))
+        try:
+            embs = await asyncio.get_running_loop().run_in_executor(self._executor, self._encode, kind, inputs)
+        except Exception as e:
+            logger.exception('encode %s failed', kind)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        elapsed = time.perf_counter() - start
+        stage_seconds.labels(kind, 'inference').observe(elapsed)
+        logger.debug('encode %s: %d in %.3fs', kind, len(inputs), elapsed)
+        offset = 0
+        for item_inputs, future, _ in batch:
+            if not future.done():
+                future.set_result(embs[offset:offset + len(item_inputs)])
+            offset += len(item_inputs)
+
 
 class RocketQAServer(web.RequestHandler):
 
     def __init__(self, application, request, **kwargs):
         web.RequestHandler.__init__(self, application, request)
-        self._dual_encoder = kwargs["dual_encoder"]
+        self._scheduler = kwargs["scheduler"]
 
-    def post(self):
+    async def post(self):
         input_request = self.request.body
         output = {'error_code': 0, 'error_message': ''}
         if input_request is None:
@@ -33,26 +147,38 @@ class RocketQAServer(web.RequestHandler):
 
         if input_data['step'] == 1:
             # encode query
-            query = input_data['query']
-            start = time.time()
-            q_embs = self._dual_encoder.encode_query(query=query)
-            q_embs = [x.tolist() for x in list(q_embs)]
-            end = time.time()
-            print('encode query: {}s'.format(end - start))
-            output['result'] = q_embs
+            kind = 'query'
+            q_embs = await self._scheduler.encode(kind, input_data['query'])
 
         elif input_data['step'] == 3:
-            titles = input_data['titles']
-            paras = input_data['paras']
-            start = time.time()
-            q_embs = self._dual_encoder.encode_para(title=titles, para=paras)
-            q_embs = [x.tolist() for x in list(q_embs)]
-            end = time.time()
-            print('encode para: {}s'.format(end - start))
-            output['result'] = q_embs
+            kind = 'para'
+            q_embs = await self._scheduler.encode(kind, list(zip(input_data['titles'], input_data['paras'])))
+
+        else:
+            self.write(json.dumps(output))
+            return
+
+        start = time.perf_counter()
+        if BINARY_TYPE in self.request.headers.get('Accept', ''):
+            self.set_header('Content-Type', BINARY_TYPE)
+            self.set_header('X-Shape', '{},{}'.format(*q_embs.shape))
+            self.write(q_embs.astype('<f4', copy=False).tobytes())
+        else:
+            output['result'] = q_embs.tolist()
+            result_str = json.dumps(output, ensure_ascii=False)
+            self.write(result_str)
+        stage_seconds.labels(kind, 'serialize').observe(time.perf_counter() - start)
+
+
+class MetricsHandler(web.RequestHandler):
 
-        result_str = json.dumps(output, ensure_ascii=False)
-        self.write(result_str)
+    def get(self):
+        registry = REGISTRY
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:  # server.start(0) 会启动多个进程
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        self.set_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.write(generate_latest(registry))
 
 
 def create_rocketqa_app(sub_address, rocketqa_server):
@@ -60,17 +186,24 @@ def create_rocketqa_app(sub_address, rocketqa_server):
         "model": 'zh_dureader_de_v2',
         "use_cuda": False,
         "device_id": 0,
-        "batch_size": 1
+        "batch_size": max(QUERY_BATCH_SIZE, PARA_BATCH_SIZE)
     }
     dual_encoder = rocketqa.load_model(**de_conf)
-    return web.Application([(sub_address, rocketqa_server, dict(dual_encoder=dual_encoder))])
+    scheduler = BatchScheduler(dual_encoder, {'query': QUERY_BATCH_SIZE, 'para': PARA_BATCH_SIZE}, MAX_WAIT)
+    app = web.Application([(sub_address, rocketqa_server, dict(scheduler=scheduler)),
+                           (r'/metrics', MetricsHandler)])
+    return app, scheduler
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+                        format='%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s')
     sub_address = r'/rocketqa'
     port = 25565
-    app = create_rocketqa_app(sub_address, RocketQAServer)
+    app, scheduler = create_rocketqa_app(sub_address, RocketQAServer)
     server = httpserver.HTTPServer(app)
     server.bind(port)
     server.start(0)
+    # fork 之后在每个进程自己的事件循环里启动调度
+    ioloop.IOLoop.current().spawn_callback(scheduler.run)
     ioloop.IOLoop.current().start()